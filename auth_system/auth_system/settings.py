@@ -55,12 +55,114 @@ REST_FRAMEWORK = {
     ],
 }
 
+# Кеш решений CustomPermission в памяти процесса. Сбрасывается сигналами,
+# TTL (в секундах) ограничивает устаревание в остальных воркерах
+PERMISSION_CACHE_TTL = int(os.getenv('PERMISSION_CACHE_TTL', '60'))
+# Сколько последних пользователей держать в кеше ролей и ресурсов (LRU)
+PERMISSION_CACHE_MAX_USERS = int(os.getenv('PERMISSION_CACHE_MAX_USERS', '10000'))
+
+# Кеш токенов SessionTokenAuthentication: локальный LRU процесса и общий
+# кеш Django (CACHES), через который его делят воркеры
+TOKEN_CACHE = {
+    'BACKEND': os.getenv('TOKEN_CACHE_BACKEND', 'custom_auth.cache.TokenCache'),
+    'OPTIONS': {
+        'LOCAL_MAX_SIZE': int(os.getenv('TOKEN_CACHE_LOCAL_MAX_SIZE', '10000')),
+        'LOCAL_TTL': int(os.getenv('TOKEN_CACHE_LOCAL_TTL', '5')),
+        'SHARED_TTL': int(os.getenv('TOKEN_CACHE_SHARED_TTL', '300')),
+        'CACHE_ALIAS': 'default',
+    },
+}
+
+# Поиск по открытому токену для строк, созданных до хэширования токенов.
+# Включается только на время перехода существующей базы (см. README,
+# "Хранение токенов"): с ним каждый поиск идет по двум индексам
+SESSION_TOKEN_LEGACY_LOOKUP = os.getenv('SESSION_TOKEN_LEGACY_LOOKUP', 'False').lower() in ('true', '1', 'yes')
+
+# Forward-auth (/auth/verify) для nginx auth_request и Envoy ext_authz.
+# URI исходного запроса сопоставляется с ресурсом по префиксам ROUTES
+# ([('/reports/', 'reports'), ...]), затем по маршрутам URLCONF;
+# UNMAPPED - ответ для несопоставленных URI: deny (403) или allow (200)
+FORWARD_AUTH = {
+    'URLCONF': 'auth_system.urls',
+    'ROUTES': [],
+    'UNMAPPED': os.getenv('FORWARD_AUTH_UNMAPPED', 'deny'),
+}
+
+# Скомпилированный файл политики (manage.py compile_policy), который воркеры
+# отображают в память и делят через page cache. Пустой PATH - выключено;
+# CHECK_INTERVAL - как часто воркер проверяет, не заменен ли файл
+POLICY_BUNDLE = {
+    'PATH': os.getenv('POLICY_BUNDLE_PATH', ''),
+    'CHECK_INTERVAL': float(os.getenv('POLICY_BUNDLE_CHECK_INTERVAL', '1')),
+    # Файл старше MAX_AGE секунд воркеры не используют (без compile_policy
+    # --watch права снова берутся из БД); 0 - без ограничения
+    'MAX_AGE': float(os.getenv('POLICY_BUNDLE_MAX_AGE', str(PERMISSION_CACHE_TTL))),
+    'CACHE_ALIAS': 'default',
+}
+
+# Лимит одновременных сессий пользователя: при входе сверх лимита самые
+# старые токены деактивируются; 0 - без ограничения
+MAX_SESSIONS_PER_USER = int(os.getenv('MAX_SESSIONS_PER_USER', '20'))
+
+# Время жизни подписанного access-токена в секундах. Роли в его claims
+# могут устареть не более чем на это время
+ACCESS_TOKEN_LIFETIME = int(os.getenv('ACCESS_TOKEN_LIFETIME', '300'))
+
+# Пул хэширования паролей для регистрации и входа.
+# EXECUTOR: process (в обход GIL), thread или inline (в потоке запроса).
+# При заполнении очереди MAX_QUEUE запросы получают 429
+PASSWORD_HASHING = {
+    'EXECUTOR': os.getenv('PASSWORD_HASHING_EXECUTOR', 'process'),
+    'MAX_WORKERS': int(os.getenv('PASSWORD_HASHING_MAX_WORKERS', '2')),
+    'MAX_QUEUE': int(os.getenv('PASSWORD_HASHING_MAX_QUEUE', '64')),
+    'TIMEOUT': int(os.getenv('PASSWORD_HASHING_TIMEOUT', '30')),
+}
+
+# Замеры этапов запроса (AuthMiddleware, аутентификация, проверка прав, view):
+# заголовок Server-Timing, лог custom_auth.instrumentation и метрики /metrics.
+# При выключенном флаге middleware не подключается
+AUTH_INSTRUMENTATION = os.getenv('AUTH_INSTRUMENTATION', 'False').lower() in ('true', '1', 'yes')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'custom_auth.instrumentation': {'handlers': ['console'], 'level': 'INFO'},
+    },
+}
+
+# Ограничение попыток входа (GCRA) по email и IP: 'N/min' - не больше N попыток
+# в минуту со всплеском до N. Пустое значение отключает ограничение.
+# CACHE_ALIAS - общий кеш для всех воркеров, иначе состояние в памяти процесса
+LOGIN_THROTTLE = {
+    'RATES': {
+        'email': os.getenv('LOGIN_THROTTLE_EMAIL_RATE', '5/min'),
+        'ip': os.getenv('LOGIN_THROTTLE_IP_RATE', '30/min'),
+    },
+    'LOCAL_MAX_SIZE': int(os.getenv('LOGIN_THROTTLE_LOCAL_MAX_SIZE', '100000')),
+    'CACHE_ALIAS': os.getenv('LOGIN_THROTTLE_CACHE_ALIAS') or None,
+}
+
+# Отложенная запись last_login и журнала входов (LoginEvent): пачкой при
+# MAX_SIZE событиях или раз в FLUSH_INTERVAL секунд; 0 - запись сразу
+LOGIN_BUFFER = {
+    'MAX_SIZE': int(os.getenv('LOGIN_BUFFER_MAX_SIZE', '1000')),
+    'FLUSH_INTERVAL': float(os.getenv('LOGIN_BUFFER_FLUSH_INTERVAL', '5')),
+}
+
 MIDDLEWARE = [
+    'custom_auth.instrumentation.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    # Токен разбирается до view; под ASGI - через async ORM, DRF затем
+    # берет готовый результат без запросов к БД
+    'custom_auth.middleware.AuthMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -89,21 +191,63 @@ WSGI_APPLICATION = 'auth_system.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
-# DATABASES = {
-#     'default': {
-#         'ENGINE': 'django.db.backends.sqlite3',
-#         'NAME': BASE_DIR / 'db.sqlite3',
-#     }
-# }
+# DB_ENGINE=sqlite3 позволяет запускать проект и бенчмарки без PostgreSQL
+if os.getenv('DB_ENGINE') == 'sqlite3':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.getenv('SQLITE_PATH', BASE_DIR / 'db.sqlite3'),
+            # Сколько секунд ждать блокировку базы при параллельных записях
+            'OPTIONS': {'timeout': int(os.getenv('SQLITE_TIMEOUT', '20'))},
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.getenv('DB_NAME', 'auth_system'),
+            'USER': os.getenv('DB_USER', 'postgres'),
+            'PASSWORD': os.getenv('DB_PASSWORD', '25052003'),
+            'HOST': os.getenv('DB_HOST', 'localhost'),
+            'PORT': os.getenv('DB_PORT', '5432'),
+        }
+    }
+
+# Реплика для чтения токенов и прав (custom_auth.routers.AuthReplicaRouter).
+# Для проверки на одной машине реплику заменяет копия SQLite-файла
+# (SQLITE_REPLICA_PATH); без реплики все запросы идут в default
+if os.getenv('DB_ENGINE') == 'sqlite3' and os.getenv('SQLITE_REPLICA_PATH'):
+    DATABASES['replica'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.getenv('SQLITE_REPLICA_PATH'),
+    }
+elif os.getenv('DB_ENGINE') != 'sqlite3' and os.getenv('DB_REPLICA_HOST'):
+    DATABASES['replica'] = {
+        **DATABASES['default'],
+        'NAME': os.getenv('DB_REPLICA_NAME', DATABASES['default']['NAME']),
+        'HOST': os.getenv('DB_REPLICA_HOST'),
+        'PORT': os.getenv('DB_REPLICA_PORT', DATABASES['default']['PORT']),
+    }
+if 'replica' in DATABASES:
+    # В тестах реплика - то же соединение, что и default
+    DATABASES['replica']['TEST'] = {'MIRROR': 'default'}
+    DATABASE_ROUTERS = ['custom_auth.routers.AuthReplicaRouter']
+
+AUTH_REPLICAS = {
+    'ALIASES': [alias for alias in DATABASES if alias != 'default'],
+    # Сколько секунд после изменения читать из primary; должно
+    # превышать типичное отставание реплики
+    'PIN_SECONDS': int(os.getenv('DB_REPLICA_PIN_SECONDS', '5')),
+    'CACHE_ALIAS': 'default',
+}
 
-DATABASES = {
+# Общий кеш для воркеров, например
+# CACHE_BACKEND=django.core.cache.backends.redis.RedisCache
+# CACHE_LOCATION=redis://127.0.0.1:6379/1
+CACHES = {
     'default': {
-        'ENGINE': 'django.db.backends.postgresql',
-        'NAME': os.getenv('DB_NAME', 'auth_system'),
-        'USER': os.getenv('DB_USER', 'postgres'),
-        'PASSWORD': os.getenv('DB_PASSWORD', '25052003'),
-        'HOST': os.getenv('DB_HOST', 'localhost'),
-        'PORT': os.getenv('DB_PORT', '5432'),
+        'BACKEND': os.getenv('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('CACHE_LOCATION', ''),
     }
 }
 
@@ -0,0 +1,12 @@
+"""
+Forward-auth profile: DJANGO_SETTINGS_MODULE=auth_system.settings_forward_auth
+
+A separate process that only answers reverse-proxy auth subrequests on
+/auth/verify, without middleware and without the API routes.
+"""
+
+from .settings_production import *  # noqa: F401,F403
+
+# Токен проверяется самим view, сессии, CSRF и AuthMiddleware не нужны
+MIDDLEWARE = []
+ROOT_URLCONF = 'auth_system.urls_forward_auth'
@@ -0,0 +1,23 @@
+"""
+Production profile: DJANGO_SETTINGS_MODULE=auth_system.settings_production
+
+Persistent database connections with health checks.
+"""
+
+import os
+
+from .settings import *  # noqa: F401,F403
+from .settings import DATABASES, SECRET_KEY
+
+DEBUG = os.getenv('DEBUG', 'False').lower() in ('true', '1', 'yes')
+SECRET_KEY = os.getenv('SECRET_KEY', SECRET_KEY)
+ALLOWED_HOSTS = [host for host in os.getenv('ALLOWED_HOSTS', 'localhost').split(',') if host]
+
+# Соединение с БД переиспользуется между запросами воркера вместо
+# подключения и TLS-рукопожатия на каждый запрос. Перед повторным
+# использованием соединение проверяется (CONN_HEALTH_CHECKS), поэтому
+# перезапуск PostgreSQL или pgbouncer не приводит к ошибке запроса.
+# Настройки действуют и на реплику, если она задана
+for database in DATABASES.values():
+    database['CONN_MAX_AGE'] = int(os.getenv('DB_CONN_MAX_AGE', '60'))
+    database['CONN_HEALTH_CHECKS'] = os.getenv('DB_CONN_HEALTH_CHECKS', 'True').lower() in ('true', '1', 'yes')
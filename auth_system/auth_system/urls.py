@@ -1,7 +1,11 @@
 from django.contrib import admin
 from django.urls import path, include
+from custom_auth.forward_auth import forward_auth
+from custom_auth.instrumentation import metrics_view
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include('custom_auth.urls')),  # Убедитесь, что нет лишних пробелов
+    path('metrics', metrics_view),
+    path('auth/verify', forward_auth),
 ]
\ No newline at end of file
@@ -0,0 +1,7 @@
+from django.urls import path
+from custom_auth.forward_auth import forward_auth
+
+# Только проверка forward-auth, см. settings_forward_auth
+urlpatterns = [
+    path('auth/verify', forward_auth),
+]
@@ -77,8 +77,11 @@ def create_test_data():
         ('task_delete', 'DELETE', 'Delete task'),
         ('role_management', 'GET', 'View roles'),
         ('role_management', 'POST', 'Create role'),
+        ('role_assignment', 'POST', 'Assign roles to users'),
         ('resource_management', 'GET', 'View resources'),
         ('permission_management', 'GET', 'View permissions'),
+        ('user_management', 'POST', 'Import users'),
+        ('authorization_check', 'POST', 'Check permissions of other users'),
     ]
 
     resources = {}
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import User, Role, UserRole, Resource, Permission, SessionToken
+from .models import User, Role, UserRole, Resource, Permission, SessionToken, UserEffectivePermission, LoginEvent
 
 @admin.register(User)
 class UserAdmin(admin.ModelAdmin):
@@ -30,6 +30,27 @@ class PermissionAdmin(admin.ModelAdmin):
 
 @admin.register(SessionToken)
 class SessionTokenAdmin(admin.ModelAdmin):
-    list_display = ['user', 'token', 'is_active', 'created_at', 'expires_at']
+    # Сам токен не хранится, для опознания сессии показываются его первые символы
+    list_display = ['user', 'prefix', 'is_active', 'created_at', 'expires_at']
     list_filter = ['is_active', 'created_at']
-    readonly_fields = ['token']
\ No newline at end of file
+    search_fields = ['user__email', 'prefix']
+    readonly_fields = ['prefix']
+
+@admin.register(UserEffectivePermission)
+class UserEffectivePermissionAdmin(admin.ModelAdmin):
+    # Таблица пересчитывается автоматически, вручную не редактируется
+    list_display = ['user', 'resource', 'can_access']
+    list_filter = ['can_access']
+    search_fields = ['user__email', 'resource__name']
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+
+@admin.register(LoginEvent)
+class LoginEventAdmin(admin.ModelAdmin):
+    list_display = ['email', 'success', 'ip_address', 'created_at']
+    list_filter = ['success', 'created_at']
+    search_fields = ['email', 'ip_address']
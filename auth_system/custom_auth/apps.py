@@ -2,4 +2,12 @@ from django.apps import AppConfig
 
 class CustomAuthConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
-    name = 'custom_auth'
\ No newline at end of file
+    name = 'custom_auth'
+
+    def ready(self):
+        from . import checks, signals  # noqa: F401
+        from .resources import resource_index
+        
+        # Маршруты роутера сопоставляются с именами ресурсов при старте,
+        # id ресурсов подтягиваются из БД при первой проверке прав
+        resource_index.compile_routes()
@@ -0,0 +1,116 @@
+import atexit
+import logging
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+from .cache import get_token_cache
+from .models import LoginEvent, User
+
+logger = logging.getLogger('custom_auth.audit')
+
+
+class LoginBuffer:
+    # Отложенная запись учета входов: last_login и LoginEvent копятся в памяти
+    # и сбрасываются пачкой (bulk_update / bulk_create) при MAX_SIZE записей
+    # или раз в FLUSH_INTERVAL секунд из фонового потока. last_login одного
+    # пользователя схлопывается до последнего значения, поэтому частые входы
+    # в один аккаунт не конкурируют за блокировку строки. При остановке
+    # процесса буфер сбрасывается через atexit.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._last_logins = {}
+        self._events = []
+        self._timer = None
+        self._stopped = threading.Event()
+        self.flushed = 0
+        self.failed = 0
+
+    @property
+    def config(self):
+        config = {
+            'MAX_SIZE': 1000,
+            'FLUSH_INTERVAL': 5,
+        }
+        config.update(getattr(settings, 'LOGIN_BUFFER', {}))
+        return config
+
+    def record(self, request, user=None, success=True, email=''):
+        event = LoginEvent(
+            user_id=getattr(user, 'pk', None),
+            email=(email or getattr(user, 'email', ''))[:254],
+            ip_address=request.META.get('REMOTE_ADDR') or None,
+            user_agent=request.META.get('HTTP_USER_AGENT', '')[:255],
+            success=success,
+        )
+        config = self.config
+        with self._lock:
+            if success and user is not None:
+                self._last_logins[user.pk] = event.created_at
+            self._events.append(event)
+            size = len(self._events)
+        # FLUSH_INTERVAL = 0 - запись сразу, в потоке запроса
+        if not config['FLUSH_INTERVAL'] or size >= config['MAX_SIZE']:
+            self.flush()
+        else:
+            self._start()
+        return event
+
+    def _start(self):
+        # Поток запускается лениво, уже в процессе воркера после fork
+        if self._timer is None or not self._timer.is_alive():
+            with self._lock:
+                if self._timer is None or not self._timer.is_alive():
+                    self._stopped.clear()
+                    self._timer = threading.Thread(target=self._run, name='login-buffer', daemon=True)
+                    self._timer.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.config['FLUSH_INTERVAL']):
+            close_old_connections()
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            last_logins, self._last_logins = self._last_logins, {}
+            events, self._events = self._events, []
+        if not last_logins and not events:
+            return 0
+
+        try:
+            with transaction.atomic():
+                # update_fields-аналог: меняется только last_login, updated_at не трогается
+                User.objects.bulk_update(
+                    [User(pk=user_id, last_login=last_login) for user_id, last_login in last_logins.items()],
+                    ['last_login'],
+                    batch_size=self.config['MAX_SIZE'],
+                )
+                LoginEvent.objects.bulk_create(events, batch_size=self.config['MAX_SIZE'])
+            # bulk_update не отправляет сигналы: закешированный профиль
+            # должен увидеть новый last_login
+            token_cache = get_token_cache()
+            for user_id in last_logins:
+                token_cache.evict_user(user_id)
+        except Exception:
+            self.failed += len(events)
+            logger.exception('Failed to flush %d login events', len(events))
+            return 0
+        self.flushed += len(events)
+        return len(events)
+
+    def stop(self):
+        self._stopped.set()
+        self.flush()
+
+    def stats(self):
+        return {
+            'pending': len(self._events),
+            'flushed': self.flushed,
+            'failed': self.failed,
+        }
+
+
+login_buffer = LoginBuffer()
+atexit.register(login_buffer.stop)
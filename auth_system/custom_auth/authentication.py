@@ -1,32 +1,148 @@
+from django.db import DEFAULT_DB_ALIAS
 from rest_framework import authentication
 from rest_framework import exceptions
-from .models import SessionToken, User
-from datetime import datetime
+from .cache import get_token_cache
+from .instrumentation import stage
+from .models import SessionToken
+from .routers import ais_pinned, is_pinned, replica_active, replica_reads
+from .tokens import AccessToken, AccessTokenError
+
+def get_token_key(request):
+    token_key = request.META.get('HTTP_AUTHORIZATION')
+    
+    if not token_key:
+        return None
+    
+    # Убираем префикс "Bearer " если есть
+    if token_key.startswith('Bearer '):
+        token_key = token_key[7:]
+    return token_key
+
+def resolve_token(request, authenticator=None):
+    # Токен запроса разбирается один раз: результат (или ошибка) запоминается
+    # на HttpRequest, и AuthMiddleware с SessionTokenAuthentication получают
+    # одно и то же решение без повторного запроса к БД
+    request = getattr(request, '_request', request)
+    if not hasattr(request, '_token_resolution'):
+        authenticator = authenticator or SessionTokenAuthentication()
+        try:
+            with replica_reads():
+                request._token_resolution = authenticator.authenticate_token(get_token_key(request))
+        except exceptions.AuthenticationFailed as e:
+            request._token_resolution = e
+    return _unpack(request._token_resolution)
+
+async def aresolve_token(request, authenticator=None):
+    request = getattr(request, '_request', request)
+    if not hasattr(request, '_token_resolution'):
+        authenticator = authenticator or SessionTokenAuthentication()
+        try:
+            with replica_reads():
+                request._token_resolution = await authenticator.aauthenticate_token(get_token_key(request))
+        except exceptions.AuthenticationFailed as e:
+            request._token_resolution = e
+    return _unpack(request._token_resolution)
+
+def _unpack(resolution):
+    if isinstance(resolution, exceptions.AuthenticationFailed):
+        raise resolution
+    return resolution
 
 class SessionTokenAuthentication(authentication.BaseAuthentication):
     def authenticate(self, request):
-        token_key = request.META.get('HTTP_AUTHORIZATION')
+        with stage('authentication'):
+            return resolve_token(request, self)
+    
+    def authenticate_token(self, token_key):
+        if not token_key:
+            return None
         
+        # Подписанный access-токен проверяется без обращения к БД
+        if AccessToken.is_access_token(token_key):
+            try:
+                access_token = AccessToken.verify(token_key)
+            except AccessTokenError as e:
+                raise exceptions.AuthenticationFailed(str(e))
+            return (access_token.get_user(), access_token)
+        
+        return self.authenticate_credentials(token_key)
+    
+    async def aauthenticate_token(self, token_key):
         if not token_key:
             return None
         
-        # Убираем префикс "Bearer " если есть
-        if token_key.startswith('Bearer '):
-            token_key = token_key[7:]
+        if AccessToken.is_access_token(token_key):
+            try:
+                access_token = await AccessToken.averify(token_key)
+            except AccessTokenError as e:
+                raise exceptions.AuthenticationFailed(str(e))
+            return (access_token.get_user(), access_token)
         
-        try:
-            token = SessionToken.objects.select_related('user').get(
-                token=token_key,
-                is_active=True
-            )
-            
-            if not token.is_valid():
-                raise exceptions.AuthenticationFailed('Token expired')
-            
-            if not token.user.is_active:
-                raise exceptions.AuthenticationFailed('User inactive')
-            
-            return (token.user, token)
-            
-        except SessionToken.DoesNotExist:
-            raise exceptions.AuthenticationFailed('Invalid token')
\ No newline at end of file
+        return await self.aauthenticate_credentials(token_key)
+    
+    def authenticate_credentials(self, token_key):
+        # Сначала пробуем кеш токенов, на прогретом кеше запроса к БД нет
+        # Ключ и кеша, и поиска в БД - SHA-256 токена
+        token_hash = SessionToken.hash_token(token_key)
+        token_cache = get_token_cache()
+        cached = token_cache.get(token_hash)
+        if cached is not None:
+            return self._check_cached(token_cache, token_hash, *cached)
+        
+        queryset = SessionToken.objects.select_related('user').filter(
+            SessionToken.lookup(token_key, token_hash),
+            is_active=True
+        )
+        token = queryset.first()
+        
+        # Только что выданного токена может еще не быть в реплике, а после
+        # logout или деактивации она может видеть его активным - такие
+        # токены перечитываются из primary
+        if replica_active() and (token is None or is_pinned('user', token.user_id)):
+            token = queryset.using(DEFAULT_DB_ALIAS).first()
+        
+        if token is None:
+            raise exceptions.AuthenticationFailed('Invalid token')
+        
+        # Строка, еще не перехэшированная rehash_tokens, кешируется под тем же ключом
+        token.token_hash = token_hash
+        self._check_token(token)
+        token_cache.set(token)
+        return (token.user, token)
+    
+    async def aauthenticate_credentials(self, token_key):
+        token_hash = SessionToken.hash_token(token_key)
+        token_cache = get_token_cache()
+        cached = await token_cache.aget(token_hash)
+        if cached is not None:
+            return self._check_cached(token_cache, token_hash, *cached)
+        
+        queryset = SessionToken.objects.select_related('user').filter(
+            SessionToken.lookup(token_key, token_hash),
+            is_active=True
+        )
+        token = await queryset.afirst()
+        
+        if replica_active() and (token is None or await ais_pinned('user', token.user_id)):
+            token = await queryset.using(DEFAULT_DB_ALIAS).afirst()
+        
+        if token is None:
+            raise exceptions.AuthenticationFailed('Invalid token')
+        
+        token.token_hash = token_hash
+        self._check_token(token)
+        await token_cache.aset(token)
+        return (token.user, token)
+    
+    def _check_cached(self, token_cache, token_hash, user, token):
+        if not token.is_valid():
+            token_cache.evict(token_hash)
+            raise exceptions.AuthenticationFailed('Token expired')
+        return (user, token)
+    
+    def _check_token(self, token):
+        if not token.is_valid():
+            raise exceptions.AuthenticationFailed('Token expired')
+        
+        if not token.user.is_active:
+            raise exceptions.AuthenticationFailed('User inactive')
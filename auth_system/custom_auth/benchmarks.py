@@ -0,0 +1,326 @@
+import time
+import uuid
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.backends.signals import connection_created
+from django.test import AsyncClient
+from django.test.utils import CaptureQueriesContext, override_settings
+from rest_framework.test import APIClient
+
+from .audit import login_buffer
+from .cache import get_token_cache
+from .models import SessionToken, User
+
+SCENARIOS = {}
+
+
+def scenario(name):
+    def decorator(func):
+        SCENARIOS[name] = func
+        return func
+    return decorator
+
+
+class Rollback(Exception):
+    pass
+
+
+def run_in_rollback(func, *args, **kwargs):
+    # Сценарии создают собственные данные и откатывают их после замеров
+    result = None
+    try:
+        with transaction.atomic():
+            result = func(*args, **kwargs)
+            raise Rollback
+    except Rollback:
+        pass
+    return result
+
+
+def make_client():
+    return APIClient(SERVER_NAME='localhost')
+
+
+def make_async_client():
+    # AsyncClient в Django 4.2 всегда отправляет Host: testserver и не
+    # берет хост из SERVER_NAME, поэтому сценарии с ним разрешают этот хост
+    return AsyncClient()
+
+
+def async_allowed_hosts():
+    # Непустой список отключает неявный localhost при DEBUG, поэтому
+    # localhost для make_client добавляется явно
+    return [*settings.ALLOWED_HOSTS, 'localhost', 'testserver']
+
+
+def measure(client, method, path, count, **extra):
+    # Возвращает (запросов к БД на HTTP-запрос, запросов в секунду)
+    queries = 0
+    started = time.perf_counter()
+    for _ in range(count):
+        with CaptureQueriesContext(connection) as captured:
+            response = getattr(client, method)(path, **extra)
+        assert response.status_code < 400, (path, response.status_code)
+        queries += len(captured)
+    elapsed = time.perf_counter() - started
+    return queries / count, count / elapsed
+
+
+def ameasure(client, method, path, count, **extra):
+    # Async-клиент выполняет запросы к БД в основном потоке,
+    # поэтому запросы считаются снаружи event loop
+    async def run():
+        for _ in range(count):
+            response = await getattr(client, method)(path, **extra)
+            assert response.status_code < 400, (path, response.status_code)
+
+    started = time.perf_counter()
+    with CaptureQueriesContext(connection) as captured:
+        async_to_sync(run)()
+    elapsed = time.perf_counter() - started
+    return len(captured) / count, count / elapsed
+
+
+def create_bench_user(**fields):
+    user = User(email=f'bench-{uuid.uuid4().hex[:12]}@example.com', **fields)
+    user.set_password(uuid.uuid4().hex)
+    user.save()
+    return user
+
+
+@scenario('token_cache')
+def bench_token_cache(requests=500, **options):
+    def run():
+        user = create_bench_user()
+        token = SessionToken.generate_token(user)
+        client = make_client()
+        headers = {'HTTP_AUTHORIZATION': f'Bearer {token.key}'}
+        token_cache = get_token_cache()
+
+        token_cache.evict(token.token_hash)
+        token_cache.evict_user(user.pk)
+        cold = measure(client, 'get', '/api/auth/profile/', 1, **headers)
+        warm = measure(client, 'get', '/api/auth/profile/', requests, **headers)
+
+        token_cache.evict(token.token_hash)
+        token_cache.evict_user(user.pk)
+        return [
+            ('cold cache', 1, *cold),
+            ('warm cache', requests, *warm),
+        ]
+
+    return run_in_rollback(run)
+
+
+@scenario('login')
+def bench_login(requests=50, **options):
+    def run():
+        password = uuid.uuid4().hex
+        user = create_bench_user()
+        user.set_password(password)
+        user.save(update_fields=['password_hash'])
+        client = make_client()
+        data = {'email': user.email, 'password': password}
+        # Замеряется сам вход, а не ограничение попыток
+        with override_settings(LOGIN_THROTTLE={'RATES': {}}):
+            result = measure(client, 'post', '/api/auth/login/', requests, data=data, format='json')
+        # Записи журнала входов должны попасть в откатываемую транзакцию
+        login_buffer.flush()
+        return [
+            ('login', requests, *result),
+        ]
+
+    return run_in_rollback(run)
+
+
+@scenario('asgi')
+def bench_asgi(requests=500, **options):
+    # Тот же запрос через WSGI-обработчик и через ASGI-обработчик в том же
+    # процессе; под настоящим сервером - loadtest --url (см. README)
+
+    def run():
+        user = create_bench_user()
+        token = SessionToken.generate_token(user)
+        headers = {'HTTP_AUTHORIZATION': f'Bearer {token.key}'}
+        with override_settings(ALLOWED_HOSTS=async_allowed_hosts()):
+            sync_client = make_client()
+            async_client = make_async_client()
+            measure(sync_client, 'get', '/api/auth/profile/', 1, **headers)
+            sync_result = measure(sync_client, 'get', '/api/auth/profile/', requests, **headers)
+            # AsyncClient передает заголовки через headers, а не через META
+            async_headers = {'headers': {'Authorization': f'Bearer {token.key}'}}
+            ameasure(async_client, 'get', '/api/auth/profile/', 1, **async_headers)
+            async_result = ameasure(async_client, 'get', '/api/auth/profile/', requests, **async_headers)
+        return [
+            ('wsgi (sync)', requests, *sync_result),
+            ('asgi (async)', requests, *async_result),
+        ]
+
+    return run_in_rollback(run)
+
+
+@scenario('token_lookup')
+def bench_token_lookup(requests=500, **options):
+    # С AuthMiddleware и выключенным кешем токенов каждый запрос должен
+    # делать ровно один запрос к SessionToken: middleware и DRF
+    # разделяют результат resolve_token
+    token_cache = {'BACKEND': 'custom_auth.cache.BaseTokenCache'}
+    table = SessionToken._meta.db_table
+
+    def check_lookups(name, captured):
+        lookups = sum(table in query['sql'] for query in captured)
+        assert lookups == requests, f'{name}: {lookups} token lookups for {requests} requests'
+        return lookups / requests
+
+    def run():
+        user = create_bench_user()
+        token = SessionToken.generate_token(user)
+        headers = {'HTTP_AUTHORIZATION': f'Bearer {token.key}'}
+        async_headers = {'headers': {'Authorization': f'Bearer {token.key}'}}
+        with override_settings(TOKEN_CACHE=token_cache, ALLOWED_HOSTS=async_allowed_hosts()):
+            sync_client = make_client()
+            async_client = make_async_client()
+            with CaptureQueriesContext(connection) as sync_captured:
+                sync_rps = measure(sync_client, 'get', '/api/auth/profile/', requests, **headers)[1]
+            with CaptureQueriesContext(connection) as async_captured:
+                async_rps = ameasure(async_client, 'get', '/api/auth/profile/', requests, **async_headers)[1]
+        return [
+            ('wsgi lookups', requests, check_lookups('wsgi', sync_captured), sync_rps),
+            ('asgi lookups', requests, check_lookups('asgi', async_captured), async_rps),
+        ]
+
+    return run_in_rollback(run)
+
+
+@scenario('forward_auth')
+def bench_forward_auth(requests=500, **options):
+    # Задержка /auth/verify на прогретых кешах: через полный стек middleware
+    # и в профиле settings_forward_auth (без middleware). Запросов к БД быть
+    # не должно, в пояснении - p50 и p99 в миллисекундах
+    from .models import Permission, Resource, Role, UserRole
+
+    def latencies(client, headers):
+        client.get('/auth/verify', **headers)
+        samples = []
+        with CaptureQueriesContext(connection) as captured:
+            for _ in range(requests):
+                started = time.perf_counter()
+                response = client.get('/auth/verify', **headers)
+                samples.append(time.perf_counter() - started)
+                assert response.status_code == 200, response.status_code
+        samples.sort()
+        p50, p99 = samples[len(samples) // 2], samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+        return len(captured) / requests, requests / sum(samples), f'p50={p50 * 1000:.3f}ms p99={p99 * 1000:.3f}ms'
+
+    def run():
+        user = create_bench_user()
+        role = Role.objects.create(name=f'bench-{uuid.uuid4().hex[:12]}')
+        resource, _ = Resource.objects.get_or_create(name='project_list', method='GET')
+        Permission.objects.create(role=role, resource=resource)
+        UserRole.objects.create(user=user, role=role)
+        token = SessionToken.generate_token(user)
+        headers = {
+            'HTTP_AUTHORIZATION': f'Bearer {token.key}',
+            'HTTP_X_ORIGINAL_METHOD': 'GET',
+            'HTTP_X_ORIGINAL_URI': '/api/projects/?page=1',
+        }
+        rows = [('full middleware', requests, *latencies(make_client(), headers))]
+        with override_settings(MIDDLEWARE=[], ROOT_URLCONF='auth_system.urls_forward_auth'):
+            rows.append(('forward-auth profile', requests, *latencies(make_client(), headers)))
+        return rows
+
+    return run_in_rollback(run)
+
+
+@scenario('policy_bundle')
+def bench_policy_bundle(requests=500, **options):
+    # Проверка прав для requests пользователей с ролями (seed_benchmark_data):
+    # кеш процесса, который каждый воркер заполняет и хранит сам, против
+    # файла политики, отображенного в память. В пояснении - память кеша
+    # одного воркера и размер файла, общего для всех воркеров
+    import os
+    import tempfile
+    import tracemalloc
+
+    from .cache import PermissionCache
+    from .models import UserRole
+    from .policy import PolicyBundle, build_policy, write_policy
+    from .resources import resource_index
+
+    users = [
+        User(pk=user_id) for user_id in
+        UserRole.objects.order_by('user_id').values_list('user_id', flat=True).distinct()[:requests]
+    ]
+    resource_ids = resource_index.get_resources().get(('project_list', 'GET'), [])
+
+    def checks(is_allowed):
+        started = time.perf_counter()
+        with CaptureQueriesContext(connection) as captured:
+            for user in users:
+                is_allowed(user, resource_ids)
+        return len(captured) / len(users), len(users) / (time.perf_counter() - started)
+
+    with override_settings(POLICY_BUNDLE={'PATH': ''}):
+        cache = PermissionCache(ttl=0)
+        tracemalloc.start()
+        cold = checks(cache.is_allowed)
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        warm = checks(cache.is_allowed)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'policy.bin')
+        data, report = build_policy()
+        write_policy(data, path)
+        bundle = PolicyBundle(path)
+        mapped = checks(lambda user, resource_ids: bundle.is_allowed(user.pk, resource_ids))
+
+    return [
+        ('cache, cold', len(users), *cold, f'memory={memory / 1024:.0f}KB per worker'),
+        ('cache, warm', len(users), *warm),
+        ('policy bundle', len(users), *mapped, f'file={len(data) / 1024:.0f}KB shared'),
+    ]
+
+
+@scenario('connections')
+def bench_connections(requests=500, **options):
+    # Цикл запроса как в обработчике Django: request_started и
+    # request_finished вызывают close_old_connections, между ними - поиск
+    # токена. Сравнивается подключение на каждый запрос (CONN_MAX_AGE=0) и
+    # постоянные соединения с проверкой и без. Данные не меняются, поэтому
+    # сценарий не использует откатываемую транзакцию
+    settings_dict = connection.settings_dict
+    original = {key: settings_dict.get(key) for key in ('CONN_MAX_AGE', 'CONN_HEALTH_CHECKS')}
+    lookup_hash = SessionToken.hash_token('connection-benchmark')
+    connects = []
+
+    def on_connect(connection, **kwargs):
+        connects.append(connection.alias)
+
+    def run(max_age, health_checks):
+        connection.close()
+        settings_dict['CONN_MAX_AGE'] = max_age
+        settings_dict['CONN_HEALTH_CHECKS'] = health_checks
+        del connects[:]
+        started = time.perf_counter()
+        with CaptureQueriesContext(connection) as captured:
+            for _ in range(requests):
+                close_old_connections()
+                SessionToken.objects.filter(token_hash=lookup_hash).exists()
+                close_old_connections()
+        elapsed = time.perf_counter() - started
+        return len(captured) / requests, requests / elapsed, f'{len(connects) / requests:.2f} connects/req'
+
+    connection_created.connect(on_connect)
+    try:
+        return [
+            ('CONN_MAX_AGE=0', requests, *run(0, False)),
+            ('CONN_MAX_AGE=60', requests, *run(60, False)),
+            ('+ CONN_HEALTH_CHECKS', requests, *run(60, True)),
+        ]
+    finally:
+        connection_created.disconnect(on_connect)
+        connection.close()
+        settings_dict.update(original)
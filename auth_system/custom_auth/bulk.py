@@ -0,0 +1,125 @@
+from django.db import transaction
+
+from .cache import permission_cache
+from .effective import refresh_effective_permissions
+from .hierarchy import descendant_users
+from .models import Permission, Resource, Role, User, UserRole
+from .routers import pin_primary
+
+BATCH_SIZE = 500
+
+
+def _error(index, errors):
+    return {"index": index, "status": "error", "errors": errors}
+
+
+def _validate(items, serializer_class, references):
+    # Все элементы проверяются за один проход: ссылки на связанные объекты
+    # разрешаются одним запросом на модель, а не запросом на элемент
+    results = [None] * len(items)
+    valid = {}
+    for index, item in enumerate(items):
+        serializer = serializer_class(data=item)
+        if not serializer.is_valid():
+            results[index] = _error(index, serializer.errors)
+            continue
+        valid[index] = serializer.validated_data
+
+    existing = {}
+    for field, model in references.items():
+        ids = {data[field] for data in valid.values()}
+        existing[field] = set(model.objects.filter(pk__in=ids).values_list('pk', flat=True))
+
+    seen = {}
+    for index, data in list(valid.items()):
+        missing = {
+            field: [f"Invalid pk \"{data[field]}\" - object does not exist."]
+            for field in references if data[field] not in existing[field]
+        }
+        if missing:
+            results[index] = _error(index, missing)
+            del valid[index]
+            continue
+
+        # Повторы в одном пакете ломают INSERT ... ON CONFLICT в PostgreSQL
+        key = tuple(data[field] for field in references)
+        if key in seen:
+            results[seen[key]] = _error(seen[key], {"non_field_errors": [f"Duplicate of item {index}"]})
+            del valid[seen[key]]
+        seen[key] = index
+    return results, valid
+
+
+def bulk_grant_permissions(items, serializer_class):
+    results, valid = _validate(items, serializer_class, {'role': Role, 'resource': Resource})
+    if not valid:
+        return results
+
+    pairs = {(data['role'], data['resource']) for data in valid.values()}
+    with transaction.atomic():
+        existing = set(
+            Permission.objects.filter(
+                role_id__in={role for role, _ in pairs},
+                resource_id__in={resource for _, resource in pairs},
+            ).values_list('role_id', 'resource_id')
+        ) & pairs
+
+        Permission.objects.bulk_create(
+            [
+                Permission(role_id=data['role'], resource_id=data['resource'], can_access=data['can_access'])
+                for data in valid.values()
+            ],
+            batch_size=BATCH_SIZE,
+            update_conflicts=True,
+            unique_fields=['role', 'resource'],
+            update_fields=['can_access'],
+        )
+        # bulk_create не отправляет сигналы, кеш и UserEffectivePermission
+        # обновляются один раз на пакет
+        refresh_effective_permissions(
+            user_ids=descendant_users({role for role, _ in pairs}),
+            resource_ids={resource for _, resource in pairs},
+        )
+        transaction.on_commit(permission_cache.invalidate)
+        transaction.on_commit(lambda: pin_primary('permissions'))
+
+    for index, data in valid.items():
+        created = (data['role'], data['resource']) not in existing
+        results[index] = {"index": index, "status": "created" if created else "updated"}
+    return results
+
+
+def bulk_assign_roles(items, serializer_class, allowed_roles=None):
+    # allowed_roles - роли, которые вызывающий может назначать (None - любые)
+    results, valid = _validate(items, serializer_class, {'user': User, 'role': Role})
+    if allowed_roles is not None:
+        for index, data in list(valid.items()):
+            if data['role'] not in allowed_roles:
+                results[index] = _error(index, {"role": ["You can only assign roles you hold."]})
+                del valid[index]
+    if not valid:
+        return results
+
+    pairs = {(data['user'], data['role']) for data in valid.values()}
+    user_ids = {user for user, _ in pairs}
+    with transaction.atomic():
+        existing = set(
+            UserRole.objects.filter(
+                user_id__in=user_ids,
+                role_id__in={role for _, role in pairs},
+            ).values_list('user_id', 'role_id')
+        ) & pairs
+
+        UserRole.objects.bulk_create(
+            [UserRole(user_id=data['user'], role_id=data['role']) for data in valid.values()],
+            batch_size=BATCH_SIZE,
+            ignore_conflicts=True,
+        )
+        refresh_effective_permissions(user_ids=user_ids)
+        transaction.on_commit(lambda: permission_cache.invalidate_users(user_ids))
+        transaction.on_commit(lambda: pin_primary('permissions'))
+
+    for index, data in valid.items():
+        created = (data['user'], data['role']) not in existing
+        results[index] = {"index": index, "status": "created" if created else "exists"}
+    return results
@@ -0,0 +1,463 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.test.signals import setting_changed
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import Permission, Role, RoleClosure, SessionToken, User, UserEffectivePermission
+from .policy import policy_store
+
+
+class LocalLRUCache:
+    # Ограниченный по размеру LRU с TTL для кеша в памяти процесса
+
+    def __init__(self, max_size=10000, ttl=5):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires = item
+            if expires <= time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class PermissionCache:
+    # Скомпилированная карта прав (role_id, resource_id) -> can_access,
+    # набор ролей и набор разрешенных ресурсов (из UserEffectivePermission)
+    # для каждого пользователя (не больше PERMISSION_CACHE_MAX_USERS
+    # последних пользователей). Живет в памяти процесса и сбрасывается
+    # сигналами при изменении Role, UserRole, Resource и Permission.
+    # С POLICY_BUNDLE['PATH'] решения сначала берутся из общего для воркеров
+    # файла политики (custom_auth.policy), кеш процесса - запасной путь.
+
+    def __init__(self, ttl=None, max_users=None):
+        self._lock = threading.Lock()
+        self._ttl = ttl
+        self._decisions = None
+        self._compiled_at = 0
+        if max_users is None:
+            max_users = getattr(settings, 'PERMISSION_CACHE_MAX_USERS', 10000)
+        # Срок жизни записи задается при сохранении (ttl), TTL самих LRU не ограничивает
+        self._user_roles = LocalLRUCache(max_users, float('inf'))
+        self._user_resources = LocalLRUCache(max_users, float('inf'))
+        self._role_names = None
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def ttl(self):
+        # TTL ограничивает устаревание в других процессах, до которых
+        # сигналы текущего процесса не доходят
+        if self._ttl is not None:
+            return self._ttl
+        return getattr(settings, 'PERMISSION_CACHE_TTL', 60)
+
+    def _expired(self, loaded_at):
+        return self.ttl and time.monotonic() - loaded_at > self.ttl
+
+    def _decision_rows(self):
+        return Permission.objects.values_list('role_id', 'resource_id', 'can_access')
+
+    def _fresh_decisions(self):
+        decisions = self._decisions
+        if decisions is not None and not self._expired(self._compiled_at):
+            self.hits += 1
+            return decisions
+        self.misses += 1
+        return None
+
+    def _store_decisions(self, rows):
+        decisions = {}
+        for role_id, resource_id, can_access in rows:
+            decisions[(role_id, resource_id)] = can_access
+        self._decisions = decisions
+        self._compiled_at = time.monotonic()
+        return decisions
+
+    def get_decisions(self):
+        decisions = self._fresh_decisions()
+        if decisions is not None:
+            return decisions
+        with self._lock:
+            if self._decisions is None or self._expired(self._compiled_at):
+                return self._store_decisions(self._decision_rows())
+            return self._decisions
+
+    def _fresh_entry(self, entries, user_id):
+        value = entries.get(user_id)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+        return None
+
+    def _store_entry(self, entries, user_id, rows):
+        # ttl = 0 - запись живет до вытеснения или сброса сигналом
+        value = frozenset(rows)
+        entries.set(user_id, value, self.ttl or None)
+        return value
+
+    def _user_role_rows(self, user_id):
+        # Роли пользователя вместе с унаследованными - одним запросом к замыканию
+        return RoleClosure.objects.filter(
+            descendant__userrole__user_id=user_id
+        ).values_list('ancestor_id', flat=True).distinct()
+
+    @staticmethod
+    def _bundle_roles(user_id):
+        bundle = policy_store.get(user_id)
+        role_ids = bundle.get_user_roles(user_id) if bundle is not None else None
+        return frozenset(role_ids) if role_ids is not None else None
+
+    def get_user_roles(self, user_id):
+        role_ids = self._bundle_roles(user_id) or self._fresh_entry(self._user_roles, user_id)
+        if role_ids is None:
+            role_ids = self._store_entry(self._user_roles, user_id, self._user_role_rows(user_id))
+        return role_ids
+
+    def _user_resource_rows(self, user_id):
+        # Один запрос по индексу (user_id, resource_id) вместо UserRole x Permission
+        return UserEffectivePermission.objects.filter(
+            user_id=user_id, can_access=True
+        ).values_list('resource_id', flat=True)
+
+    def get_user_resources(self, user_id):
+        resource_ids = self._fresh_entry(self._user_resources, user_id)
+        if resource_ids is None:
+            resource_ids = self._store_entry(self._user_resources, user_id, self._user_resource_rows(user_id))
+        return resource_ids
+
+    def get_role_names(self):
+        # {role_id: name} для заголовков forward-auth
+        entry = self._role_names
+        if entry is None or self._expired(entry[1]):
+            entry = self._role_names = (dict(Role.objects.values_list('id', 'name')), time.monotonic())
+        return entry[0]
+
+    @staticmethod
+    def _decide(decisions, role_ids, resource_ids):
+        # resource_ids - точный ресурс и ресурс с методом '*'
+        for role_id in role_ids:
+            for resource_id in resource_ids:
+                if decisions.get((role_id, resource_id)):
+                    return True
+        return False
+
+    def _bundle_decision(self, user, resource_ids, role_ids):
+        # Поиск по отображенному в память файлу не делает запросов к БД
+        bundle = policy_store.get(user.pk)
+        allowed = bundle.is_allowed(user.pk, resource_ids, role_ids) if bundle is not None else None
+        if allowed is not None:
+            self.hits += 1
+        return allowed
+
+    def is_allowed(self, user, resource_ids, role_ids=None):
+        # Без ролей из claims access-токена решение берется из разрешенных
+        # ресурсов пользователя, иначе - из карты прав для этих ролей
+        if not resource_ids:
+            return False
+        allowed = self._bundle_decision(user, resource_ids, role_ids)
+        if allowed is not None:
+            return allowed
+        if role_ids is None:
+            return not self.get_user_resources(user.pk).isdisjoint(resource_ids)
+        return self._decide(self.get_decisions(), role_ids, resource_ids)
+
+    def invalidate(self):
+        with self._lock:
+            self._decisions = None
+            self._user_roles.clear()
+            self._user_resources.clear()
+            self._role_names = None
+        policy_store.invalidate()
+
+    def invalidate_user(self, user_id):
+        self._user_roles.delete(user_id)
+        self._user_resources.delete(user_id)
+        policy_store.invalidate([user_id])
+
+    def invalidate_users(self, user_ids):
+        for user_id in user_ids:
+            self._user_roles.delete(user_id)
+            self._user_resources.delete(user_id)
+        policy_store.invalidate(user_ids)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'compiled': self._decisions is not None,
+            'cached_users': len(self._user_resources),
+        }
+
+
+permission_cache = PermissionCache()
+
+
+class BaseTokenCache:
+    # Кеш отключен: SessionTokenAuthentication всегда идет в БД
+
+    def __init__(self, **options):
+        pass
+
+    def get(self, token_hash):
+        return None
+
+    async def aget(self, token_hash):
+        return None
+
+    def set(self, token):
+        pass
+
+    async def aset(self, token):
+        pass
+
+    def evict(self, token_hash):
+        pass
+
+    def evict_user(self, user_id):
+        pass
+
+    def revoke_user(self, user_id):
+        pass
+
+    def stats(self):
+        return {}
+
+
+class TokenCache(BaseTokenCache):
+    # Двухуровневый кеш токенов: локальный LRU процесса и общий кеш Django,
+    # через который его делят воркеры gunicorn. Токен и пользователь хранятся
+    # под разными ключами, поэтому выход пользователя не требует перебора его
+    # токенов. Ключ записи - SHA-256 токена, хэш пароля и сам токен в кеш
+    # не попадают.
+
+    USER_FIELDS = [f.attname for f in User._meta.concrete_fields if f.attname != 'password_hash']
+    TOKEN_FIELDS = [f.attname for f in SessionToken._meta.concrete_fields if f.attname not in ('token', 'token_hash')]
+
+    def __init__(self, LOCAL_MAX_SIZE=10000, LOCAL_TTL=5, SHARED_TTL=300,
+                 CACHE_ALIAS='default', KEY_PREFIX='custom_auth'):
+        self.local = LocalLRUCache(LOCAL_MAX_SIZE, LOCAL_TTL)
+        self.shared_ttl = SHARED_TTL
+        self.cache_alias = CACHE_ALIAS
+        self.key_prefix = KEY_PREFIX
+        self.hits = 0
+        self.local_hits = 0
+        self.misses = 0
+
+    @property
+    def shared(self):
+        return caches[self.cache_alias]
+
+    def _token_key(self, token_hash):
+        # Из PostgreSQL BinaryField приходит memoryview
+        return f'{self.key_prefix}:token:{bytes(token_hash).hex()}'
+
+    def _user_key(self, user_id):
+        return f'{self.key_prefix}:user:{user_id}'
+
+    def _revoked_key(self, user_id):
+        return f'{self.key_prefix}:revoked_before:{user_id}'
+
+    def _get(self, key):
+        value = self.local.get(key)
+        if value is not None:
+            self.local_hits += 1
+            return value
+        value = self.shared.get(key)
+        if value is not None:
+            self.local.set(key, value)
+        return value
+
+    async def _aget(self, key):
+        value = self.local.get(key)
+        if value is not None:
+            self.local_hits += 1
+            return value
+        value = await self.shared.aget(key)
+        if value is not None:
+            self.local.set(key, value)
+        return value
+
+    def _set(self, key, value, ttl):
+        self.local.set(key, value, ttl)
+        self.shared.set(key, value, ttl)
+
+    async def _aset(self, key, value, ttl):
+        self.local.set(key, value, ttl)
+        await self.shared.aset(key, value, ttl)
+
+    def _delete(self, key):
+        self.local.delete(key)
+        self.shared.delete(key)
+
+    def _get_user(self, user_id):
+        # Пользователь и отметка отзыва его токенов читаются из общего кеша
+        # одним get_many и вместе лежат в локальном LRU
+        key = self._user_key(user_id)
+        value = self.local.get(key)
+        if value is not None:
+            self.local_hits += 1
+            return value
+        values = self.shared.get_many([key, self._revoked_key(user_id)])
+        return self._store_user(key, values, user_id)
+
+    async def _aget_user(self, user_id):
+        key = self._user_key(user_id)
+        value = self.local.get(key)
+        if value is not None:
+            self.local_hits += 1
+            return value
+        values = await self.shared.aget_many([key, self._revoked_key(user_id)])
+        return self._store_user(key, values, user_id)
+
+    def _store_user(self, key, values, user_id):
+        if key not in values:
+            return None
+        value = (values[key], values.get(self._revoked_key(user_id)))
+        self.local.set(key, value)
+        return value
+
+    def get(self, token_hash):
+        token_data = self._get(self._token_key(token_hash))
+        user_entry = None
+        if token_data is not None:
+            user_entry = self._get_user(token_data[0])
+        return self._build(token_data, user_entry)
+
+    async def aget(self, token_hash):
+        token_data = await self._aget(self._token_key(token_hash))
+        user_entry = None
+        if token_data is not None:
+            user_entry = await self._aget_user(token_data[0])
+        return self._build(token_data, user_entry)
+
+    def _build(self, token_data, user_entry):
+        if user_entry is None:
+            self.misses += 1
+            return None
+
+        user_data, revoked_before = user_entry
+        token = self._load(SessionToken, self.TOKEN_FIELDS, token_data[1])
+        # Выход на всех устройствах отзывает токены, выданные до него: их
+        # записи остаются в кеше до SHARED_TTL, а запись пользователя
+        # появляется снова при следующем входе
+        if revoked_before is not None and token.created_at <= revoked_before:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        user = self._load(User, self.USER_FIELDS, user_data)
+        token.user = user
+        return user, token
+
+    def _entries(self, token):
+        # Запись не должна пережить сам токен
+        ttl = min(self.shared_ttl, int((token.expires_at - timezone.now()).total_seconds()))
+        if ttl <= 0:
+            return []
+        token_data = (token.user_id, self._dump(token, self.TOKEN_FIELDS))
+        return [
+            (self._token_key(token.token_hash), token_data, ttl),
+            (self._user_key(token.user_id), self._dump(token.user, self.USER_FIELDS), ttl),
+        ]
+
+    def set(self, token):
+        # Запись пользователя попадает в локальный LRU только при чтении,
+        # вместе с отметкой отзыва
+        for key, value, ttl in self._entries(token):
+            if key == self._user_key(token.user_id):
+                self.shared.set(key, value, ttl)
+            else:
+                self._set(key, value, ttl)
+
+    async def aset(self, token):
+        for key, value, ttl in self._entries(token):
+            if key == self._user_key(token.user_id):
+                await self.shared.aset(key, value, ttl)
+            else:
+                await self._aset(key, value, ttl)
+
+    def evict(self, token_hash):
+        self._delete(self._token_key(token_hash))
+
+    def evict_user(self, user_id):
+        # Без пользователя в кеше ни один его токен не будет принят из кеша
+        self._delete(self._user_key(user_id))
+
+    def revoke_user(self, user_id):
+        # Токены, выданные до этого момента, больше не принимаются из кеша,
+        # даже когда следующий вход снова запишет пользователя. Отметка
+        # живет SHARED_TTL - дольше записей отозванных токенов
+        self.shared.set(self._revoked_key(user_id), timezone.now(), self.shared_ttl)
+        self.evict_user(user_id)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'local_hits': self.local_hits,
+            'misses': self.misses,
+            'local_size': len(self.local),
+        }
+
+    @staticmethod
+    def _dump(instance, fields):
+        return instance._state.db, [getattr(instance, f) for f in fields]
+
+    @staticmethod
+    def _load(model, fields, data):
+        return model.from_db(data[0], fields, data[1])
+
+
+_token_cache = None
+
+
+def get_token_cache():
+    global _token_cache
+    if _token_cache is None:
+        config = getattr(settings, 'TOKEN_CACHE', {})
+        backend = import_string(config.get('BACKEND', 'custom_auth.cache.TokenCache'))
+        _token_cache = backend(**config.get('OPTIONS', {}))
+    return _token_cache
+
+
+@receiver(setting_changed)
+def reset_token_cache(setting, **kwargs):
+    global _token_cache
+    if setting == 'TOKEN_CACHE':
+        _token_cache = None
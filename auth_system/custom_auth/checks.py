@@ -0,0 +1,33 @@
+from django.conf import settings
+from django.core.checks import Error, Tags, Warning, register
+
+# Бэкенды кеша, которые не разделяются между процессами
+PROCESS_LOCAL_CACHES = {
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+}
+
+
+@register(Tags.caches)
+def check_revocation_cache(app_configs, **kwargs):
+    # Denylist access-токенов (logout, деактивация) хранится в кеше
+    # TOKEN_CACHE['OPTIONS']['CACHE_ALIAS']. В кеше процесса отзыв не виден
+    # остальным воркерам до истечения ACCESS_TOKEN_LIFETIME, в DummyCache -
+    # нигде
+    alias = getattr(settings, 'TOKEN_CACHE', {}).get('OPTIONS', {}).get('CACHE_ALIAS', 'default')
+    backend = settings.CACHES.get(alias, {}).get('BACKEND')
+    if backend == 'django.core.cache.backends.dummy.DummyCache':
+        return [Error(
+            f"CACHES['{alias}'] is DummyCache, so revoked access tokens stay valid until they expire.",
+            hint='Use a shared cache such as Redis or Memcached (CACHE_BACKEND).',
+            id='custom_auth.E001',
+        )]
+    if backend in PROCESS_LOCAL_CACHES and not settings.DEBUG:
+        return [Warning(
+            f"CACHES['{alias}'] is local to each process: with several workers, logout and user "
+            f"deactivation do not revoke access tokens in other workers for up to "
+            f"ACCESS_TOKEN_LIFETIME seconds.",
+            hint='Use a shared cache such as Redis or Memcached (CACHE_BACKEND).',
+            id='custom_auth.W001',
+        )]
+    return []
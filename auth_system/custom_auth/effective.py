@@ -0,0 +1,101 @@
+from django.db import transaction
+from django.db.models import QuerySet
+
+from .models import UserEffectivePermission, UserRole
+from .resources import ALL_METHODS, resource_index
+
+BATCH_SIZE = 1000
+
+
+def _batches(user_ids, batch_size):
+    # Список id режется на пачки для IN (...); queryset уходит подзапросом целиком
+    if user_ids is None or isinstance(user_ids, QuerySet):
+        yield user_ids
+        return
+    user_ids = sorted(user_ids)
+    for start in range(0, len(user_ids), batch_size):
+        yield user_ids[start:start + batch_size]
+
+
+def _effective_rows(user_ids, resource_ids, batch_size):
+    # UserRole x RoleClosure x Permission одним запросом: доступ разрешен,
+    # если его дает хотя бы одна роль пользователя или ее предок
+    permission = 'role__ancestor_links__ancestor__permission'
+    rows = UserRole.objects.filter(**{f'{permission}__isnull': False})
+    if user_ids is not None:
+        rows = rows.filter(user_id__in=user_ids)
+    if resource_ids is not None:
+        rows = rows.filter(**{f'{permission}__resource_id__in': resource_ids})
+    rows = rows.order_by('user_id').values_list(
+        'user_id', f'{permission}__resource_id', f'{permission}__can_access'
+    )
+
+    current_user, decisions = None, {}
+    for user_id, resource_id, can_access in rows.iterator(chunk_size=batch_size):
+        if user_id != current_user:
+            yield from _flush(current_user, decisions)
+            current_user, decisions = user_id, {}
+        decisions[resource_id] = decisions.get(resource_id, False) or can_access
+    yield from _flush(current_user, decisions)
+
+
+def _flush(user_id, decisions):
+    for resource_id, can_access in decisions.items():
+        yield UserEffectivePermission(user_id=user_id, resource_id=resource_id, can_access=can_access)
+
+
+def refresh_effective_permissions(user_ids=None, resource_ids=None, batch_size=BATCH_SIZE):
+    # Пересчитывает строки UserEffectivePermission для пользователей
+    # и ресурсов (None - все) в текущей транзакции. user_ids может быть
+    # queryset'ом values('user_id'), например hierarchy.descendant_users()
+    total = 0
+    with transaction.atomic():
+        for batch in _batches(user_ids, batch_size):
+            stale = UserEffectivePermission.objects.all()
+            if batch is not None:
+                stale = stale.filter(user_id__in=batch)
+            if resource_ids is not None:
+                stale = stale.filter(resource_id__in=resource_ids)
+            stale.delete()
+
+            pending = []
+            for row in _effective_rows(batch, resource_ids, batch_size):
+                pending.append(row)
+                if len(pending) >= batch_size:
+                    UserEffectivePermission.objects.bulk_create(pending)
+                    total += len(pending)
+                    pending = []
+            UserEffectivePermission.objects.bulk_create(pending)
+            total += len(pending)
+    return total
+
+
+def check_permissions(users, checks):
+    # Пакетная проверка прав: users - {user_id: is_superuser} активных
+    # пользователей, checks - [(имя ресурса, метод)]. Ресурсы берутся из
+    # индекса ресурсов (ресурс с методом '*' подходит к любому методу),
+    # решения - одним запросом к UserEffectivePermission на всех
+    # пользователей, поэтому число запросов не зависит от размера пакета.
+    # Возвращает {user_id: [allowed, ...]} в порядке checks
+    resources = resource_index.get_resources()
+    check_resources = [
+        frozenset(resources.get((name, method), []) + resources.get((name, ALL_METHODS), []))
+        for name, method in checks
+    ]
+    resource_ids = set().union(*check_resources)
+
+    allowed = {}
+    regular = [user_id for user_id, is_superuser in users.items() if not is_superuser]
+    if regular and resource_ids:
+        for user_id, resource_id in UserEffectivePermission.objects.filter(
+            user_id__in=regular, resource_id__in=resource_ids, can_access=True
+        ).values_list('user_id', 'resource_id'):
+            allowed.setdefault(user_id, set()).add(resource_id)
+
+    return {
+        user_id: [
+            bool(is_superuser or not ids.isdisjoint(allowed.get(user_id, ())))
+            for ids in check_resources
+        ]
+        for user_id, is_superuser in users.items()
+    }
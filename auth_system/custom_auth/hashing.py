@@ -0,0 +1,194 @@
+import atexit
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from django.conf import settings
+from django.contrib.auth.hashers import check_password, get_hasher, identify_hasher, make_password
+from rest_framework import exceptions
+
+
+class HashingPoolSaturated(exceptions.Throttled):
+    default_detail = 'Password hashing capacity exhausted, retry later.'
+
+
+def _init_worker():
+    # При запуске через spawn дочернему процессу нужны настройки Django
+    import django
+    django.setup()
+
+
+def _make_password(raw_password):
+    started = time.time()
+    return make_password(raw_password), started, time.time() - started
+
+
+def _check_password(raw_password, encoded):
+    started = time.time()
+    return check_password(raw_password, encoded), started, time.time() - started
+
+
+def must_update(encoded):
+    # Хэш нужно пересчитать, если сменился хэшер по умолчанию
+    # или число итераций
+    preferred = get_hasher('default')
+    try:
+        hasher = identify_hasher(encoded)
+    except ValueError:
+        return False
+    return hasher.algorithm != preferred.algorithm or preferred.must_update(encoded)
+
+
+class HashingMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+        self.hash_seconds = 0.0
+        self.hash_seconds_max = 0.0
+        self.queue_wait_seconds = 0.0
+        self.queue_wait_seconds_max = 0.0
+        self.rejected = 0
+
+    def record(self, hash_seconds, queue_wait_seconds):
+        with self._lock:
+            self.count += 1
+            self.hash_seconds += hash_seconds
+            self.hash_seconds_max = max(self.hash_seconds_max, hash_seconds)
+            self.queue_wait_seconds += queue_wait_seconds
+            self.queue_wait_seconds_max = max(self.queue_wait_seconds_max, queue_wait_seconds)
+
+    def stats(self):
+        return {
+            'count': self.count,
+            'rejected': self.rejected,
+            'hash_seconds_avg': self.hash_seconds / self.count if self.count else 0.0,
+            'hash_seconds_max': self.hash_seconds_max,
+            'queue_wait_seconds_avg': self.queue_wait_seconds / self.count if self.count else 0.0,
+            'queue_wait_seconds_max': self.queue_wait_seconds_max,
+        }
+
+
+class HashingPool:
+    # Выносит PBKDF2 из потока запроса в пул процессов (в обход GIL).
+    # Очередь ограничена MAX_QUEUE: при переполнении запрос получает 429,
+    # а не ждет, блокируя воркер.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor = None
+        self._slots = None
+        self.metrics = HashingMetrics()
+
+    @property
+    def config(self):
+        config = {
+            'EXECUTOR': 'process',
+            'MAX_WORKERS': None,
+            'MAX_QUEUE': 64,
+            'TIMEOUT': 30,
+        }
+        config.update(getattr(settings, 'PASSWORD_HASHING', {}))
+        return config
+
+    def _get_executor(self):
+        # Пул создается лениво, уже в процессе воркера после fork
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    config = self.config
+                    self._slots = threading.BoundedSemaphore(config['MAX_QUEUE'])
+                    if config['EXECUTOR'] == 'process':
+                        self._executor = ProcessPoolExecutor(config['MAX_WORKERS'], initializer=_init_worker)
+                    elif config['EXECUTOR'] == 'thread':
+                        self._executor = ThreadPoolExecutor(config['MAX_WORKERS'])
+        return self._executor
+
+    def _submit(self, executor, func, *args):
+        # Место в очереди занимается без ожидания; None - очередь заполнена
+        if not self._slots.acquire(blocking=False):
+            return None
+        try:
+            future = executor.submit(func, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+        return future
+
+    def _result(self, future, submitted):
+        try:
+            result, started, elapsed = future.result(timeout=self.config['TIMEOUT'])
+        except FutureTimeoutError:
+            self.metrics.rejected += 1
+            raise HashingPoolSaturated()
+        self.metrics.record(elapsed, max(started - submitted, 0.0))
+        return result
+
+    def _run(self, func, *args):
+        if self.config['EXECUTOR'] == 'inline':
+            result, started, elapsed = func(*args)
+            self.metrics.record(elapsed, 0.0)
+            return result
+
+        executor = self._get_executor()
+        submitted = time.time()
+        future = self._submit(executor, func, *args)
+        if future is None:
+            self.metrics.rejected += 1
+            raise HashingPoolSaturated()
+        return self._result(future, submitted)
+
+    def make_password(self, raw_password):
+        return self._run(_make_password, raw_password)
+
+    def make_passwords(self, raw_passwords):
+        # Пакетное хэширование (импорт пользователей). Пакет занимает не
+        # больше половины MAX_QUEUE, остальное место остается входам; когда
+        # места нет, ждет свои уже отправленные пароли. Если очередь целиком
+        # занята другими запросами - HashingPoolSaturated, как у входа
+        if self.config['EXECUTOR'] == 'inline':
+            return [self.make_password(raw_password) for raw_password in raw_passwords]
+
+        executor = self._get_executor()
+        limit = max(1, self.config['MAX_QUEUE'] // 2)
+        results, pending = [], deque()
+        for raw_password in raw_passwords:
+            while True:
+                submitted = time.time()
+                future = self._submit(executor, _make_password, raw_password) if len(pending) < limit else None
+                if future is not None:
+                    break
+                if not pending:
+                    self.metrics.rejected += 1
+                    raise HashingPoolSaturated()
+                results.append(self._result(*pending.popleft()))
+            pending.append((future, submitted))
+        while pending:
+            results.append(self._result(*pending.popleft()))
+        return results
+
+    def check_password(self, raw_password, encoded):
+        return self._run(_check_password, raw_password, encoded)
+
+    def verify_user_password(self, user, raw_password):
+        is_correct = self.check_password(raw_password, user.password_hash)
+        if is_correct and must_update(user.password_hash):
+            # Прозрачно пересчитываем хэш под текущий хэшер; при
+            # перегрузке пула это не должно мешать входу
+            try:
+                user.password_hash = self.make_password(raw_password)
+            except HashingPoolSaturated:
+                return is_correct
+            user.save(update_fields=['password_hash'])
+        return is_correct
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+hashing_pool = HashingPool()
+atexit.register(hashing_pool.shutdown)
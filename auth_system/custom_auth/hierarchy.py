@@ -0,0 +1,50 @@
+from django.db import transaction
+
+from .models import Role, RoleClosure, UserRole
+
+
+def closure_rows(parents):
+    # {(ancestor_id, descendant_id): depth} по ссылкам на родителя.
+    # seen защищает от зацикливания, если цикл уже попал в БД в обход clean()
+    rows = {}
+    for role_id in parents:
+        current, depth, seen = role_id, 0, set()
+        while current is not None and current not in seen:
+            seen.add(current)
+            rows[(current, role_id)] = depth
+            current = parents.get(current)
+            depth += 1
+    return rows
+
+
+def rebuild_role_closure():
+    # Замыкание пересчитывается целиком по parent_id: ролей немного, а
+    # пересчет при записи избавляет проверку прав от рекурсивного обхода.
+    # Возвращает id ролей, у которых изменился набор предков
+    with transaction.atomic():
+        parents = dict(Role.objects.values_list('id', 'parent_id'))
+        rows = closure_rows(parents)
+        existing = {
+            (ancestor_id, descendant_id): depth
+            for ancestor_id, descendant_id, depth in RoleClosure.objects.values_list(
+                'ancestor_id', 'descendant_id', 'depth'
+            )
+        }
+        stale = set(existing) - set(rows)
+        changed = {pair for pair, depth in rows.items() if existing.get(pair) != depth}
+
+        for ancestor_id, descendant_id in stale:
+            RoleClosure.objects.filter(ancestor_id=ancestor_id, descendant_id=descendant_id).delete()
+        RoleClosure.objects.bulk_create(
+            [RoleClosure(ancestor_id=a, descendant_id=d, depth=rows[(a, d)]) for a, d in changed],
+            update_conflicts=True,
+            unique_fields=['descendant', 'ancestor'],
+            update_fields=['depth'],
+        )
+    return {descendant_id for _, descendant_id in stale | changed}
+
+
+def descendant_users(role_ids):
+    # Подзапрос пользователей, получающих права ролей role_ids
+    # напрямую или через наследование
+    return UserRole.objects.filter(role__ancestor_links__ancestor_id__in=role_ids).values('user_id')
@@ -0,0 +1,198 @@
+import csv
+import itertools
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from django.contrib.auth.hashers import identify_hasher, make_password
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import IntegrityError, transaction
+
+from .effective import refresh_effective_permissions
+from .hashing import _init_worker
+from .models import Role, User, UserRole
+
+BATCH_SIZE = 1000
+PROFILE_FIELDS = ['first_name', 'last_name', 'patronymic']
+
+
+def read_rows(stream, format='csv'):
+    # Построчное чтение без загрузки файла в память. CSV - с заголовком,
+    # роли в колонке roles через ';'; NDJSON - объект на строку, roles - список
+    if format == 'csv':
+        for row in csv.DictReader(stream):
+            row['roles'] = [name for name in (row.get('roles') or '').split(';') if name]
+            yield row
+    elif format == 'ndjson':
+        for line in stream:
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # Битая строка становится ошибкой строки, а не прерывает импорт
+                    yield None
+    else:
+        raise ValueError(f'Unknown import format: {format}')
+
+
+def _clean(row, role_ids):
+    if not isinstance(row, dict):
+        return None, {'non_field_errors': ['Malformed row.']}
+    email = (row.get('email') or '').strip()
+    try:
+        validate_email(email)
+    except ValidationError:
+        return None, {'email': ['Enter a valid email address.']}
+
+    errors = {}
+    password, password_hash = row.get('password'), row.get('password_hash')
+    if password_hash:
+        # Готовый хэш в формате Django (например, pbkdf2_sha256$...)
+        try:
+            identify_hasher(password_hash)
+        except ValueError:
+            errors['password_hash'] = ['Unknown password hash format.']
+    elif not password or len(password) < 6:
+        errors['password'] = ['Password or password_hash is required (min 6 characters).']
+
+    roles = row.get('roles') or []
+    unknown = [name for name in roles if name not in role_ids]
+    if unknown:
+        errors['roles'] = [f'Unknown role "{name}".' for name in unknown]
+    if errors:
+        return None, errors
+
+    user = User(email=email, password_hash=password_hash or '', **{
+        field: row[field] for field in PROFILE_FIELDS if row.get(field)
+    })
+    return (user, None if password_hash else password, {role_ids[name] for name in roles}), None
+
+
+class _PasswordHasher:
+    # Пул процессов создается при первом открытом пароле: импорт готовых
+    # хэшей его не запускает. workers=None - по числу CPU, 1 - в текущем процессе
+    def __init__(self, workers):
+        self.workers = workers
+        self.executor = None
+
+    def __call__(self, passwords):
+        if not passwords or self.workers == 1:
+            return [make_password(password) for password in passwords]
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(self.workers, initializer=_init_worker)
+        return list(self.executor.map(make_password, passwords, chunksize=16))
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+def _insert(batch):
+    # batch: [(row, user, roles)] с уже посчитанными хэшами. Повторно
+    # проверяем email внутри транзакции: пока считались хэши, часть
+    # пользователей могла зарегистрироваться сама
+    existing = set(User.objects.filter(email__in=[user.email for _, user, _ in batch]).values_list('email', flat=True))
+    batch = [item for item in batch if item[1].email not in existing]
+    for _, user, _ in batch:
+        # После отката предыдущей попытки у объектов мог остаться pk
+        user.pk = None
+    User.objects.bulk_create([user for _, user, _ in batch], batch_size=BATCH_SIZE)
+    ids = dict(User.objects.filter(email__in=[user.email for _, user, _ in batch]).values_list('email', 'id'))
+    UserRole.objects.bulk_create(
+        [UserRole(user_id=ids[user.email], role_id=role_id) for _, user, roles in batch for role_id in roles],
+        batch_size=BATCH_SIZE,
+        ignore_conflicts=True,
+    )
+    # bulk_create не отправляет сигналы
+    if ids:
+        refresh_effective_permissions(user_ids=list(ids.values()))
+    return batch, existing
+
+
+def import_users(rows, batch_size=BATCH_SIZE, offset=0, workers=None, default_roles=(), totals=None,
+                 hash_passwords=None):
+    # Потоковый импорт пользователей. Строки читаются пачками по batch_size,
+    # на пачку: проверка, дедупликация email (внутри пачки и одним запросом
+    # к БД), хэширование паролей в пуле из workers процессов или готовые хэши,
+    # bulk_create пользователей и ролей и пересчет прав в одной транзакции.
+    # После каждой пачки отдается отчет; offset в нем - сколько строк
+    # обработано, с него импорт продолжается после сбоя. В памяти
+    # одновременно не больше одной пачки. hash_passwords - функция пакетного
+    # хэширования (для HTTP-импорта - общий пул hashing_pool), иначе свой пул
+    # из workers процессов
+    role_ids = dict(Role.objects.values_list('name', 'id'))
+    missing = [name for name in default_roles if name not in role_ids]
+    if missing:
+        raise ValueError(f'Unknown role: {", ".join(missing)}')
+    default_role_ids = {role_ids[name] for name in default_roles}
+
+    own_hasher = _PasswordHasher(workers)
+    hash_passwords = hash_passwords or own_hasher
+    rows = itertools.islice(rows, offset, None)
+    totals = dict(totals or {'created': 0, 'existing': 0, 'errors': 0})
+    try:
+        while True:
+            chunk = list(itertools.islice(rows, batch_size))
+            if not chunk:
+                break
+
+            errors = []
+            valid = {}
+            for row_number, row in enumerate(chunk, offset):
+                cleaned, row_errors = _clean(row, role_ids)
+                if row_errors:
+                    errors.append({'row': row_number, 'errors': row_errors})
+                elif cleaned[0].email in valid:
+                    errors.append({'row': row_number, 'errors': {'email': ['Duplicate email in import.']}})
+                else:
+                    valid[cleaned[0].email] = (row_number, *cleaned)
+
+            existing = set(
+                User.objects.filter(email__in=[item[1].email for item in valid.values()])
+                .values_list('email', flat=True)
+            )
+            pending = [item for item in valid.values() if item[1].email not in existing]
+
+            to_hash = [item for item in pending if item[2] is not None]
+            for item, password_hash in zip(to_hash, hash_passwords([item[2] for item in to_hash])):
+                item[1].password_hash = password_hash
+
+            batch = [(row_number, user, roles | default_role_ids) for row_number, user, _, roles in pending]
+            try:
+                with transaction.atomic():
+                    created, raced = _insert(batch)
+            except IntegrityError:
+                # Регистрация успела между проверкой и вставкой: пачка
+                # откатилась целиком, повторная проверка ее отфильтрует
+                with transaction.atomic():
+                    created, raced = _insert(batch)
+
+            offset += len(chunk)
+            report = {
+                'offset': offset,
+                'created': len(created),
+                'existing': len(existing) + len(raced),
+                'errors': errors,
+            }
+            totals['created'] += report['created']
+            totals['existing'] += report['existing']
+            totals['errors'] += len(errors)
+            yield {**report, 'totals': dict(totals)}
+    finally:
+        own_hasher.shutdown()
+
+
+def read_checkpoint(path):
+    if path and os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return None
+
+
+def write_checkpoint(path, report):
+    # Атомарная запись: после сбоя файл содержит последнюю закоммиченную пачку
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'offset': report['offset'], 'totals': report['totals']}, f)
+    os.replace(tmp_path, path)
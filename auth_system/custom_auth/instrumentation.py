@@ -0,0 +1,226 @@
+import json
+import logging
+import threading
+import time
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.http import HttpResponse, HttpResponseNotFound
+
+logger = logging.getLogger('custom_auth.instrumentation')
+
+BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0]
+
+_current = ContextVar('custom_auth_request_timings', default=None)
+
+
+class RequestTimings:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.active = []
+
+    def add(self, name, seconds=0.0, queries=0, db_seconds=0.0):
+        stage = self.stages.setdefault(name, {'seconds': 0.0, 'queries': 0, 'db_seconds': 0.0})
+        stage['seconds'] += seconds
+        stage['queries'] += queries
+        stage['db_seconds'] += db_seconds
+
+    def record_query(self, seconds):
+        # Запрос относится к самому вложенному активному этапу, остальные - к view
+        self.add(self.active[-1] if self.active else 'view', queries=1, db_seconds=seconds)
+
+
+class stage:
+    # Замер этапа запроса. Без активного InstrumentationMiddleware
+    # стоит одного обращения к ContextVar
+    __slots__ = ('name', 'timings', 'started')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.timings = _current.get()
+        if self.timings is not None:
+            self.timings.active.append(self.name)
+            self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.timings is not None:
+            self.timings.add(self.name, time.perf_counter() - self.started)
+            self.timings.active.pop()
+
+
+def _query_wrapper(execute, sql, params, many, context):
+    timings = _current.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timings.record_query(time.perf_counter() - started)
+
+
+def _install_query_wrapper(connection, **kwargs):
+    if _query_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_query_wrapper)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.durations = {}
+        self.queries = {}
+        self.requests = 0
+
+    def observe(self, timings):
+        with self._lock:
+            self.requests += 1
+            for name, values in timings.stages.items():
+                self.durations.setdefault(name, Histogram()).observe(values['seconds'])
+                self.queries[name] = self.queries.get(name, 0) + values['queries']
+
+    def render(self):
+        # Текстовый формат Prometheus
+        lines = [
+            '# TYPE auth_requests_total counter',
+            f'auth_requests_total {self.requests}',
+            '# TYPE auth_stage_duration_seconds histogram',
+        ]
+        with self._lock:
+            for name, histogram in sorted(self.durations.items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f'auth_stage_duration_seconds_bucket{{stage="{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'auth_stage_duration_seconds_bucket{{stage="{name}",le="+Inf"}} {histogram.count}')
+                lines.append(f'auth_stage_duration_seconds_sum{{stage="{name}"}} {histogram.sum}')
+                lines.append(f'auth_stage_duration_seconds_count{{stage="{name}"}} {histogram.count}')
+            lines.append('# TYPE auth_stage_db_queries_total counter')
+            for name, count in sorted(self.queries.items()):
+                lines.append(f'auth_stage_db_queries_total{{stage="{name}"}} {count}')
+        lines.extend(self._cache_lines())
+        return '\n'.join(lines) + '\n'
+
+    def _cache_lines(self):
+        from .audit import login_buffer
+        from .cache import get_token_cache, permission_cache
+        from .hashing import hashing_pool
+        from .policy import policy_store
+
+        lines = ['# TYPE auth_cache_events_total counter']
+        for cache_name, stats in [('permission', permission_cache.stats()), ('token', get_token_cache().stats())]:
+            for event in ('hits', 'misses'):
+                if event in stats:
+                    lines.append(f'auth_cache_events_total{{cache="{cache_name}",event="{event}"}} {stats[event]}')
+        lines.append('# TYPE auth_password_hashing gauge')
+        for name, value in hashing_pool.metrics.stats().items():
+            lines.append(f'auth_password_hashing{{metric="{name}"}} {value}')
+        lines.append('# TYPE auth_login_buffer gauge')
+        for name, value in login_buffer.stats().items():
+            lines.append(f'auth_login_buffer{{metric="{name}"}} {value}')
+        lines.append('# TYPE auth_policy_bundle gauge')
+        for name, value in policy_store.stats().items():
+            if value is not None:
+                lines.append(f'auth_policy_bundle{{metric="{name}"}} {value}')
+        return lines
+
+
+metrics = Metrics()
+
+
+class InstrumentationMiddleware:
+    # Время и запросы к БД по этапам запроса: AuthMiddleware, аутентификация
+    # DRF, CustomPermission и view. Результат уходит в заголовок Server-Timing,
+    # в лог custom_auth.instrumentation и в гистограммы для /metrics.
+    # При AUTH_INSTRUMENTATION = False middleware не подключается вовсе.
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'AUTH_INSTRUMENTATION', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+        connection_created.connect(_install_query_wrapper, dispatch_uid='custom_auth_instrumentation')
+        for connection in connections.all(initialized_only=True):
+            _install_query_wrapper(connection)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        timings = RequestTimings()
+        token = _current.set(timings)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, timings)
+
+    async def __acall__(self, request):
+        timings = RequestTimings()
+        token = _current.set(timings)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, timings)
+
+    def finish(self, request, response, timings):
+        total = time.perf_counter() - timings.started
+        # Все, что не попало в отдельные этапы, считается временем view
+        measured = sum(values['seconds'] for name, values in timings.stages.items() if name != 'view')
+        timings.add('view', max(total - measured, 0.0))
+        metrics.observe(timings)
+
+        response['Server-Timing'] = ', '.join(
+            f'{name};dur={values["seconds"] * 1000:.3f};desc="queries={values["queries"]}"'
+            for name, values in timings.stages.items()
+        ) + f', total;dur={total * 1000:.3f}'
+
+        logger.info(json.dumps({
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'total_ms': round(total * 1000, 3),
+            'stages': {
+                name: {
+                    'ms': round(values['seconds'] * 1000, 3),
+                    'queries': values['queries'],
+                    'db_ms': round(values['db_seconds'] * 1000, 3),
+                }
+                for name, values in timings.stages.items()
+            },
+        }))
+        return response
+
+
+def metrics_view(request):
+    if not getattr(settings, 'AUTH_INSTRUMENTATION', False):
+        return HttpResponseNotFound()
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4')
@@ -0,0 +1,247 @@
+import http.client
+import json
+import secrets
+import threading
+import time
+from datetime import timedelta
+from urllib.parse import urlsplit
+
+from django.contrib.auth.hashers import make_password
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from .effective import refresh_effective_permissions
+from .hierarchy import descendant_users
+from .models import Permission, Resource, Role, SessionToken, User, UserRole
+
+BENCH_EMAIL = 'bench-{}@example.com'
+BENCH_ADMIN_EMAIL = 'bench-admin@example.com'
+BENCH_PASSWORD = 'bench123'
+
+# Эндпоинты нагрузочного теста: (метод, путь, чей токен, тело запроса)
+ENDPOINTS = {
+    'login': ('POST', '/api/auth/login/', None, 'credentials'),
+    'profile': ('GET', '/api/auth/profile/', 'user', None),
+    'projects': ('GET', '/api/projects/', 'user', None),
+    'permissions': ('GET', '/api/admin/permissions/', 'admin', None),
+}
+
+
+def chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def seed_benchmark_data(users=1000, tokens_per_user=1, resources=0, batch_size=10000, log=None):
+    # Данные для нагрузочного теста поверх create_test_data: пользователи
+    # bench-N с ролью user, токены и дополнительные ресурсы. Все вставки идут
+    # через bulk_create пачками, поэтому память не растет с объемом
+    # (1M пользователей и 10M токенов укладываются в несколько минут).
+    log = log or (lambda message: None)
+    password_hash = make_password(BENCH_PASSWORD)
+    user_role, _ = Role.objects.get_or_create(name='user', defaults={'description': 'Regular user role'})
+
+    User.objects.get_or_create(
+        email=BENCH_ADMIN_EMAIL,
+        defaults={'password_hash': password_hash, 'is_superuser': True},
+    )
+
+    start = User.objects.filter(email__startswith='bench-').exclude(email=BENCH_ADMIN_EMAIL).count()
+    new_users = (
+        User(email=BENCH_EMAIL.format(i), password_hash=password_hash, first_name='Bench', last_name=str(i))
+        for i in range(start, users)
+    )
+    created = 0
+    for chunk in chunks(new_users, batch_size):
+        with transaction.atomic():
+            User.objects.bulk_create(chunk, batch_size=batch_size)
+            emails = [user.email for user in chunk]
+            ids = list(User.objects.filter(email__in=emails).values_list('id', flat=True))
+            UserRole.objects.bulk_create(
+                [UserRole(user_id=user_id, role=user_role) for user_id in ids],
+                batch_size=batch_size,
+                ignore_conflicts=True,
+            )
+            expires_at = timezone.now() + timedelta(days=30)
+            for token_chunk in chunks(
+                (
+                    SessionToken.from_key(secrets.token_hex(32), user_id=user_id, expires_at=expires_at)
+                    for user_id in ids
+                    for _ in range(tokens_per_user)
+                ),
+                batch_size,
+            ):
+                SessionToken.objects.bulk_create(token_chunk, batch_size=batch_size)
+            refresh_effective_permissions(user_ids=ids, batch_size=batch_size)
+        created += len(chunk)
+        log(f'users: {start + created}/{users}')
+
+    if resources:
+        existing = Resource.objects.filter(name__startswith='bench_resource_').count()
+        new_resources = [
+            Resource(name=f'bench_resource_{i}', method='GET', description='Benchmark resource')
+            for i in range(existing, resources)
+        ]
+        Resource.objects.bulk_create(new_resources, batch_size=batch_size)
+        ids = Resource.objects.filter(name__startswith='bench_resource_').values_list('id', flat=True)
+        for chunk in chunks((Permission(role=user_role, resource_id=i) for i in ids.iterator()), batch_size):
+            Permission.objects.bulk_create(chunk, batch_size=batch_size, ignore_conflicts=True)
+        refresh_effective_permissions(user_ids=descendant_users([user_role.pk]), resource_ids=ids, batch_size=batch_size)
+        log(f'resources: {resources}')
+
+    return {
+        'users': User.objects.filter(email__startswith='bench-').count(),
+        'tokens': SessionToken.objects.filter(user__email__startswith='bench-').count(),
+        'resources': Resource.objects.count(),
+        'permissions': Permission.objects.count(),
+    }
+
+
+class InProcessTransport:
+    # Запросы через тестовый клиент Django в том же процессе;
+    # позволяет посчитать запросы к БД на каждый HTTP-запрос
+
+    def __init__(self):
+        self.client = APIClient(SERVER_NAME='localhost')
+
+    def request(self, method, path, token=None, body=None):
+        extra = {'HTTP_AUTHORIZATION': f'Bearer {token}'} if token else {}
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.generic(
+                method, path, json.dumps(body) if body else '', content_type='application/json', **extra
+            )
+        data = response.json() if response.get('Content-Type') == 'application/json' else None
+        return response.status_code, data, len(captured)
+
+    def close(self):
+        connection.close()
+
+
+class HTTPTransport:
+    # Запросы к запущенному серверу (runserver, gunicorn, uvicorn)
+    # по keep-alive соединению
+
+    def __init__(self, base_url):
+        parts = urlsplit(base_url)
+        connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        self.connection = connection_class(parts.hostname, parts.port)
+
+    def request(self, method, path, token=None, body=None):
+        headers = {'Content-Type': 'application/json'}
+        if token:
+            headers['Authorization'] = f'Bearer {token}'
+        self.connection.request(method, path, json.dumps(body) if body else None, headers)
+        response = self.connection.getresponse()
+        payload = response.read()
+        data = json.loads(payload) if response.getheader('Content-Type') == 'application/json' else None
+        return response.status, data, self.query_count(response.getheader('Server-Timing'))
+
+    @staticmethod
+    def query_count(server_timing):
+        # Число запросов к БД из Server-Timing, если на сервере
+        # включен AUTH_INSTRUMENTATION
+        if not server_timing:
+            return None
+        count = 0
+        for metric in server_timing.split(','):
+            for param in metric.split(';'):
+                if param.strip().startswith('desc="queries='):
+                    count += int(param.strip()[len('desc="queries='):-1])
+        return count
+
+    def close(self):
+        self.connection.close()
+
+
+def percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, round(percent / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def run_load_test(endpoints, requests=1000, concurrency=8, base_url=None):
+    # Каждый поток входит своим пользователем bench-N и отправляет
+    # requests / concurrency запросов к каждому эндпоинту
+    results = {name: {'latencies': [], 'errors': 0, 'queries': 0, 'counted': 0} for name in endpoints}
+    lock = threading.Lock()
+    per_worker = max(1, requests // concurrency)
+    failures = []
+
+    def login(transport, email):
+        status, data, _ = transport.request('POST', '/api/auth/login/', body={'email': email, 'password': BENCH_PASSWORD})
+        if status != 200:
+            raise RuntimeError(f'Login failed for {email}: {status} {data}')
+        return data['token']
+
+    def worker(number):
+        transport = HTTPTransport(base_url) if base_url else InProcessTransport()
+        try:
+            email = BENCH_EMAIL.format(number)
+            tokens = {'user': login(transport, email), 'admin': login(transport, BENCH_ADMIN_EMAIL)}
+            for name in endpoints:
+                method, path, auth, body = ENDPOINTS[name]
+                if body == 'credentials':
+                    body = {'email': email, 'password': BENCH_PASSWORD}
+                token = tokens.get(auth)
+                latencies = []
+                errors = queries = counted = 0
+                for _ in range(per_worker):
+                    started = time.perf_counter()
+                    status, data, query_count = transport.request(method, path, token, body)
+                    latencies.append(time.perf_counter() - started)
+                    if status >= 400:
+                        errors += 1
+                    if query_count is not None:
+                        queries += query_count
+                        counted += 1
+                with lock:
+                    result = results[name]
+                    result['latencies'].extend(latencies)
+                    result['errors'] += errors
+                    result['queries'] += queries
+                    result['counted'] += counted
+        except Exception as e:
+            failures.append(e)
+        finally:
+            transport.close()
+
+    report = []
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(number,)) for number in range(concurrency)]
+    # Повторные входы одним пользователем иначе упрутся в LOGIN_THROTTLE, а
+    # сценарий login вытеснит сверх MAX_SESSIONS_PER_USER токен самого потока;
+    # для --url оба ограничения отключаются в настройках сервера
+    with override_settings(LOGIN_THROTTLE={'RATES': {}}, MAX_SESSIONS_PER_USER=0):
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    elapsed = time.perf_counter() - started
+    if failures:
+        raise failures[0]
+
+    for name in endpoints:
+        result = results[name]
+        latencies = sorted(result['latencies'])
+        total = sum(latencies)
+        report.append({
+            'endpoint': name,
+            'requests': len(latencies),
+            'errors': result['errors'],
+            # Пропускная способность эндпоинта при заданной конкурентности
+            'rps': len(latencies) / total * concurrency if total else 0.0,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p95_ms': percentile(latencies, 95) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'queries': result['queries'] / result['counted'] if result['counted'] else None,
+        })
+    return report, elapsed
@@ -0,0 +1,108 @@
+import time
+
+from django.db import connections, router, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import SessionToken
+
+
+def reapable_tokens(now):
+    # Истекшие и деактивированные (logout, delete_account) токены
+    return Q(expires_at__lt=now) | Q(is_active=False)
+
+
+def reap_session_tokens(batch_size=1000, sleep=0.1, max_batches=None, log=None):
+    # Удаляет токены пачками по batch_size с keyset-пагинацией по id:
+    # каждая пачка - короткая транзакция, между пачками пауза sleep секунд,
+    # чтобы не держать блокировки и не нагружать реплики. Пачка удаляется
+    # одним DELETE по id без сигналов: на SessionToken никто не ссылается,
+    # истекший или деактивированный токен снова действующим не становится,
+    # а записи кеша таких токенов уже вытеснены при logout или истекут сами
+    # по TTL, поэтому post_delete (вытеснение из кеша и pin_primary на каждую
+    # строку) здесь только лишняя работа
+    now = timezone.now()
+    using = router.db_for_write(SessionToken)
+    connection = connections[using]
+    table = connection.ops.quote_name(SessionToken._meta.db_table)
+    started = time.monotonic()
+    last_id = 0
+    batches = 0
+    deleted = 0
+
+    while max_batches is None or batches < max_batches:
+        ids = list(
+            SessionToken.objects.filter(reapable_tokens(now), id__gt=last_id)
+            .order_by('id')
+            .values_list('id', flat=True)[:batch_size]
+        )
+        if not ids:
+            break
+
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {table} WHERE id IN ({", ".join(["%s"] * len(ids))})', ids)
+            count = cursor.rowcount
+        deleted += count
+        batches += 1
+        last_id = ids[-1]
+        if log:
+            log(f'batch {batches}: deleted {count} tokens (id <= {last_id})')
+
+        if len(ids) < batch_size:
+            break
+        if sleep:
+            time.sleep(sleep)
+
+    return {
+        'deleted': deleted,
+        'batches': batches,
+        'last_id': last_id,
+        'seconds': time.monotonic() - started,
+    }
+
+
+def rehash_session_tokens(batch_size=1000, sleep=0.1, max_batches=None, log=None):
+    # Переводит строки, созданные до хэширования, на token_hash: пачками по
+    # id, каждая пачка - короткая транзакция. Открытый токен стирается в той
+    # же транзакции; работающие воркеры находят строку по хэшу, а до этого -
+    # по старой колонке (SESSION_TOKEN_LEGACY_LOOKUP), поэтому простоя нет
+    started = time.monotonic()
+    last_id = 0
+    batches = 0
+    rehashed = 0
+
+    while max_batches is None or batches < max_batches:
+        rows = list(
+            SessionToken.objects.filter(token_hash__isnull=True, token__isnull=False, id__gt=last_id)
+            .order_by('id')
+            .values_list('id', 'token')[:batch_size]
+        )
+        if not rows:
+            break
+
+        with transaction.atomic():
+            SessionToken.objects.bulk_update(
+                [
+                    SessionToken(id=token_id, token_hash=SessionToken.hash_token(token), prefix=token[:8], token=None)
+                    for token_id, token in rows
+                ],
+                ['token_hash', 'prefix', 'token'],
+                batch_size=batch_size,
+            )
+        rehashed += len(rows)
+        batches += 1
+        last_id = rows[-1][0]
+        if log:
+            log(f'batch {batches}: rehashed {len(rows)} tokens (id <= {last_id})')
+
+        if len(rows) < batch_size:
+            break
+        if sleep:
+            time.sleep(sleep)
+
+    return {
+        'rehashed': rehashed,
+        'batches': batches,
+        'remaining': SessionToken.objects.filter(token_hash__isnull=True, token__isnull=False).count(),
+        'seconds': time.monotonic() - started,
+    }
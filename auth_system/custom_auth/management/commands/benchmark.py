@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from custom_auth.benchmarks import SCENARIOS
+
+class Command(BaseCommand):
+    help = 'Benchmark the authentication hot path'
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenario', choices=sorted(SCENARIOS))
+        parser.add_argument('--requests', type=int, default=500)
+
+    def handle(self, *args, **options):
+        rows = SCENARIOS[options['scenario']](**options)
+        self.stdout.write(f"{'case':<24}{'requests':>10}{'queries/req':>14}{'req/s':>12}")
+        # Сценарий может добавить к строке пояснение, например число подключений
+        for name, count, queries, rps, *notes in rows:
+            self.stdout.write(f'{name:<24}{count:>10}{queries:>14.2f}{rps:>12.1f}  {" ".join(notes)}'.rstrip())
@@ -0,0 +1,47 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+from custom_auth.policy import compile_policy, get_config, policy_changed_at
+
+class Command(BaseCommand):
+    help = 'Compile roles, resources and permissions into the memory-mapped policy bundle'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default=None,
+                            help="Bundle file (default: POLICY_BUNDLE['PATH'])")
+        parser.add_argument('--watch', action='store_true',
+                            help='Keep running and recompile when the policy changes')
+        parser.add_argument('--interval', type=float, default=1,
+                            help='Seconds between change checks in --watch mode')
+        parser.add_argument('--max-age', type=float, default=None,
+                            help="Recompile at least this often in --watch mode, even without a change mark "
+                                 "(default: half of POLICY_BUNDLE['MAX_AGE'])")
+
+    def compile(self, path):
+        report = compile_policy(path)
+        self.stdout.write(self.style.SUCCESS(
+            f"Compiled policy {report['generation']}: {report['users']} users, {report['roles']} roles, "
+            f"{report['resources']} resources, {report['size']} bytes ({report['seconds']:.2f}s)"
+        ))
+
+    def handle(self, *args, **options):
+        path = options['path'] or get_config()['PATH']
+        if not path:
+            raise CommandError('Set POLICY_BUNDLE_PATH or pass --path')
+        if not options['watch']:
+            self.compile(path)
+            return
+
+        # Изменения прав ставят отметку в общем кеше; без общего кеша
+        # (LocMemCache) файл обновляется раз в --max-age секунд, заметно
+        # раньше, чем воркеры перестанут ему доверять (MAX_AGE)
+        max_age = options['max_age'] or get_config()['MAX_AGE'] / 2 or 60
+        seen, compiled_at = None, None
+        while True:
+            changed = policy_changed_at()
+            if compiled_at is None or changed != seen or time.monotonic() - compiled_at >= max_age:
+                seen, compiled_at = changed, time.monotonic()
+                close_old_connections()
+                self.compile(path)
+            time.sleep(options['interval'])
@@ -0,0 +1,66 @@
+import json
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from custom_auth.imports import BATCH_SIZE, import_users, read_checkpoint, read_rows, write_checkpoint
+
+class Command(BaseCommand):
+    help = 'Stream users from a CSV or NDJSON file into the database in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="CSV/NDJSON file, '-' for stdin")
+        parser.add_argument('--format', choices=['csv', 'ndjson'], default=None,
+                            help='Defaults to the file extension')
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Processes for hashing plain passwords (default: CPU count, 1 - no pool)')
+        parser.add_argument('--role', action='append', dest='roles', default=[],
+                            help='Role name assigned to every imported user (repeatable)')
+        parser.add_argument('--checkpoint', default=None,
+                            help='Progress file; an interrupted import resumes from it')
+        parser.add_argument('--errors', default=None,
+                            help='Write rejected rows as NDJSON to this file')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        format = options['format'] or ('ndjson' if path.endswith(('.ndjson', '.jsonl')) else 'csv')
+        checkpoint = read_checkpoint(options['checkpoint']) or {'offset': 0, 'totals': None}
+        if checkpoint['offset']:
+            self.stdout.write(f"Resuming from row {checkpoint['offset']}")
+
+        stream = sys.stdin if path == '-' else open(path, newline='', encoding='utf-8')
+        errors_file = open(options['errors'], 'a') if options['errors'] else None
+        report = None
+        try:
+            for report in import_users(
+                read_rows(stream, format),
+                batch_size=options['batch_size'],
+                offset=checkpoint['offset'],
+                workers=options['workers'],
+                default_roles=options['roles'],
+                totals=checkpoint['totals'],
+            ):
+                if options['checkpoint']:
+                    write_checkpoint(options['checkpoint'], report)
+                for error in report['errors']:
+                    if errors_file:
+                        errors_file.write(json.dumps(error) + '\n')
+                    elif options['verbosity'] > 1:
+                        self.stderr.write(f"row {error['row']}: {error['errors']}")
+                totals = report['totals']
+                self.stdout.write(
+                    f"rows: {report['offset']}, created: {totals['created']}, "
+                    f"existing: {totals['existing']}, errors: {totals['errors']}"
+                )
+        except ValueError as e:
+            raise CommandError(str(e))
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+            if errors_file:
+                errors_file.close()
+
+        if report is not None:
+            self.stdout.write(self.style.SUCCESS(f"Imported {report['totals']['created']} users"))
+        else:
+            self.stdout.write(self.style.SUCCESS('Nothing to import'))
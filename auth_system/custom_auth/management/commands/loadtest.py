@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+from custom_auth.loadtest import ENDPOINTS, run_load_test
+
+class Command(BaseCommand):
+    help = 'Drive the auth API with concurrent clients and report latency percentiles'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--endpoints', default=','.join(ENDPOINTS),
+                            help=f"Comma separated list of: {', '.join(ENDPOINTS)}")
+        parser.add_argument('--requests', type=int, default=1000,
+                            help='Requests per endpoint')
+        parser.add_argument('--concurrency', type=int, default=8)
+        parser.add_argument('--url', default=None,
+                            help='Base URL of a running server; in-process client if omitted')
+
+    def handle(self, *args, **options):
+        endpoints = [name.strip() for name in options['endpoints'].split(',') if name.strip()]
+        unknown = set(endpoints) - set(ENDPOINTS)
+        if unknown:
+            raise CommandError(f"Unknown endpoints: {', '.join(sorted(unknown))}")
+
+        report, elapsed = run_load_test(
+            endpoints,
+            requests=options['requests'],
+            concurrency=options['concurrency'],
+            base_url=options['url'],
+        )
+        self.stdout.write(
+            f"{'endpoint':<14}{'requests':>10}{'errors':>8}{'req/s':>10}"
+            f"{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'queries/req':>14}"
+        )
+        for row in report:
+            queries = f"{row['queries']:.2f}" if row['queries'] is not None else 'n/a'
+            self.stdout.write(
+                f"{row['endpoint']:<14}{row['requests']:>10}{row['errors']:>8}{row['rps']:>10.1f}"
+                f"{row['p50_ms']:>10.2f}{row['p95_ms']:>10.2f}{row['p99_ms']:>10.2f}{queries:>14}"
+            )
+        self.stdout.write(f'Total time: {elapsed:.2f}s')
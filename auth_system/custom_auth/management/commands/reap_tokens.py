@@ -0,0 +1,32 @@
+import time
+
+from django.core.management.base import BaseCommand
+from custom_auth.maintenance import reap_session_tokens
+
+class Command(BaseCommand):
+    help = 'Delete expired and inactive session tokens in bounded batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--sleep', type=float, default=0.1,
+                            help='Pause between batches in seconds')
+        parser.add_argument('--max-batches', type=int, default=None)
+        parser.add_argument('--interval', type=int, default=None,
+                            help='Repeat every N seconds instead of running once')
+
+    def handle(self, *args, **options):
+        log = self.stdout.write if options['verbosity'] > 1 else None
+        while True:
+            report = reap_session_tokens(
+                batch_size=options['batch_size'],
+                sleep=options['sleep'],
+                max_batches=options['max_batches'],
+                log=log,
+            )
+            self.stdout.write(self.style.SUCCESS(
+                f"Reclaimed {report['deleted']} tokens in {report['batches']} batches "
+                f"({report['seconds']:.2f}s)"
+            ))
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
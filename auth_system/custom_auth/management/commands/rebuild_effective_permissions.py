@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from custom_auth.cache import permission_cache
+from custom_auth.effective import refresh_effective_permissions
+from custom_auth.hierarchy import rebuild_role_closure
+
+class Command(BaseCommand):
+    help = 'Rebuild the role closure and the materialized UserEffectivePermission table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--user', type=int, action='append', dest='user_ids',
+                            help='Rebuild only these user ids (repeatable)')
+
+    def handle(self, *args, **options):
+        rebuild_role_closure()
+        count = refresh_effective_permissions(user_ids=options['user_ids'], batch_size=options['batch_size'])
+        permission_cache.invalidate()
+        self.stdout.write(self.style.SUCCESS(f'Stored {count} effective permissions'))
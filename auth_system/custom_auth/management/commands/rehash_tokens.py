@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+from custom_auth.maintenance import rehash_session_tokens
+
+class Command(BaseCommand):
+    help = 'Replace plaintext session tokens with SHA-256 digests in bounded batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--sleep', type=float, default=0.1,
+                            help='Pause between batches in seconds')
+        parser.add_argument('--max-batches', type=int, default=None)
+
+    def handle(self, *args, **options):
+        log = self.stdout.write if options['verbosity'] > 1 else None
+        report = rehash_session_tokens(
+            batch_size=options['batch_size'],
+            sleep=options['sleep'],
+            max_batches=options['max_batches'],
+            log=log,
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"Rehashed {report['rehashed']} tokens in {report['batches']} batches "
+            f"({report['seconds']:.2f}s), {report['remaining']} remaining"
+        ))
+        if not report['remaining']:
+            self.stdout.write('All tokens are hashed; set SESSION_TOKEN_LEGACY_LOOKUP=False, '
+                              'then drop the token column with the next migration.')
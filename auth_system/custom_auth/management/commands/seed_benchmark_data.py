@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from create_test_data import create_test_data
+from custom_auth.loadtest import seed_benchmark_data
+
+class Command(BaseCommand):
+    help = 'Seed users, tokens, resources and permissions for load testing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--tokens-per-user', type=int, default=1)
+        parser.add_argument('--resources', type=int, default=0,
+                            help='Extra bench_resource_N resources granted to the user role')
+        parser.add_argument('--batch-size', type=int, default=10000)
+        parser.add_argument('--reset', action='store_true',
+                            help='Recreate base test data first (deletes all users)')
+
+    def handle(self, *args, **options):
+        if options['reset']:
+            create_test_data()
+        totals = seed_benchmark_data(
+            users=options['users'],
+            tokens_per_user=options['tokens_per_user'],
+            resources=options['resources'],
+            batch_size=options['batch_size'],
+            log=self.stdout.write,
+        )
+        self.stdout.write(self.style.SUCCESS(
+            ', '.join(f'{name}: {count}' for name, count in totals.items())
+        ))
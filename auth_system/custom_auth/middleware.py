@@ -1,29 +1,57 @@
-from django.utils.deprecation import MiddlewareMixin
-from .models import SessionToken
-from datetime import datetime
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from rest_framework import exceptions
+from .authentication import aresolve_token, resolve_token
+from .instrumentation import stage
 
-class AuthMiddleware(MiddlewareMixin):
-    def process_request(self, request):
+class AuthMiddleware:
+    # Поддерживает и WSGI, и ASGI: под ASGI токен проверяется через async ORM
+    # без перехода в поток, который требовался для MiddlewareMixin.
+    # Токен разбирается тем же resolve_token, что и в SessionTokenAuthentication,
+    # поэтому DRF повторно в БД не ходит
+    sync_capable = True
+    async_capable = True
+    
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+    
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if not self.is_skipped(request):
+            with stage('middleware'):
+                user = self.get_user(request)
+            if user is not None:
+                request.user = user
+        return self.get_response(request)
+    
+    async def __acall__(self, request):
+        if not self.is_skipped(request):
+            with stage('middleware'):
+                user = await self.aget_user(request)
+            if user is not None:
+                request.user = user
+        return await self.get_response(request)
+    
+    def is_skipped(self, request):
         # Пропускаем аутентификацию для admin и статических файлов
-        if request.path.startswith('/admin/') or request.path.startswith('/static/'):
+        return request.path.startswith('/admin/') or request.path.startswith('/static/')
+    
+    def get_user(self, request):
+        # Недействительный токен здесь означает анонимный запрос: request.user
+        # остается AnonymousUser от AuthenticationMiddleware, DRF для того же
+        # токена вернет 401
+        try:
+            resolution = resolve_token(request)
+        except exceptions.AuthenticationFailed:
             return None
-            
-        auth_header = request.META.get('HTTP_AUTHORIZATION')
-        
-        if auth_header and auth_header.startswith('Bearer '):
-            token_key = auth_header[7:]
-            try:
-                token = SessionToken.objects.select_related('user').get(
-                    token=token_key,
-                    is_active=True
-                )
-                
-                if token.is_valid():
-                    request.user = token.user
-                else:
-                    request.user = None
-                    
-            except SessionToken.DoesNotExist:
-                request.user = None
-        else:
-            request.user = None
\ No newline at end of file
+        return resolution[0] if resolution else None
+    
+    async def aget_user(self, request):
+        try:
+            resolution = await aresolve_token(request)
+        except exceptions.AuthenticationFailed:
+            return None
+        return resolution[0] if resolution else None
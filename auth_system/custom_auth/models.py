@@ -1,7 +1,11 @@
+from django.conf import settings
+from django.core.exceptions import ValidationError
 from django.db import models
+from django.db.models import Q
 from django.contrib.auth.hashers import make_password, check_password
+import hashlib
 import secrets
-from datetime import datetime, timedelta
+from datetime import timedelta
 from django.utils import timezone
 
 class User(models.Model):
@@ -32,10 +36,31 @@ class User(models.Model):
 class Role(models.Model):
     name = models.CharField(max_length=100, unique=True)
     description = models.TextField(blank=True, null=True)
+    # Роль наследует все права родителя (и его предков)
+    parent = models.ForeignKey(
+        'self', on_delete=models.SET_NULL, blank=True, null=True, related_name='children'
+    )
+    
+    def clean(self):
+        # Родителем не может быть сама роль или ее потомок
+        if self.parent_id and self.pk and RoleClosure.objects.filter(
+            ancestor_id=self.pk, descendant_id=self.parent_id
+        ).exists():
+            raise ValidationError({'parent': 'Role hierarchy cannot contain cycles.'})
     
     def __str__(self):
         return self.name
 
+class RoleClosure(models.Model):
+    # Транзитивное замыкание иерархии ролей, включая саму роль (depth = 0):
+    # descendant наследует права ancestor. Пересчитывается при записи Role
+    ancestor = models.ForeignKey(Role, on_delete=models.CASCADE, related_name='descendant_links')
+    descendant = models.ForeignKey(Role, on_delete=models.CASCADE, related_name='ancestor_links')
+    depth = models.PositiveIntegerField(default=0)
+    
+    class Meta:
+        unique_together = ['descendant', 'ancestor']
+
 class UserRole(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     role = models.ForeignKey(Role, on_delete=models.CASCADE)
@@ -73,22 +98,83 @@ class Permission(models.Model):
     class Meta:
         unique_together = ['role', 'resource']
 
-class SessionToken(models.Model):
+class UserEffectivePermission(models.Model):
+    # Материализованное UserRole x Permission: доступ пользователя к ресурсу
+    # через любую из его ролей. Поддерживается custom_auth.effective
     user = models.ForeignKey(User, on_delete=models.CASCADE)
-    token = models.CharField(max_length=64, unique=True)
+    resource = models.ForeignKey(Resource, on_delete=models.CASCADE)
+    can_access = models.BooleanField(default=True)
+    
+    class Meta:
+        unique_together = ['user', 'resource']
+
+class LoginEvent(models.Model):
+    # Журнал попыток входа. Пишется пачками через custom_auth.audit,
+    # поэтому created_at - время попытки, а не записи. Связь с пользователем
+    # без ограничения в БД: событие из буфера может пережить удаление пользователя
+    user = models.ForeignKey(
+        User, on_delete=models.SET_NULL, blank=True, null=True, db_constraint=False
+    )
+    email = models.CharField(max_length=254, blank=True)
+    ip_address = models.GenericIPAddressField(blank=True, null=True)
+    user_agent = models.CharField(max_length=255, blank=True)
+    success = models.BooleanField()
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+class SessionToken(models.Model):
+    # Отдельный индекс по user не нужен: его покрывает sessiontoken_user_active_idx
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_index=False)
+    # В БД хранится только SHA-256 токена (32 байта). Поиск - одна проба
+    # уникального индекса по хэшу
+    token_hash = models.BinaryField(max_length=32, unique=True, blank=True, null=True, editable=False)
+    # Префикс только для опознания сессии человеком, в поиске не участвует
+    prefix = models.CharField(max_length=8, blank=True, editable=False)
+    # Открытый токен строк, созданных до хэширования; очищается командой
+    # rehash_tokens. Колонка и ее уникальный индекс удаляются вторым этапом
+    # перехода, после выключения SESSION_TOKEN_LEGACY_LOOKUP
+    token = models.CharField(max_length=64, unique=True, blank=True, null=True, editable=False)
     expires_at = models.DateTimeField()
     created_at = models.DateTimeField(auto_now_add=True)
     is_active = models.BooleanField(default=True)
     
+    class Meta:
+        indexes = [
+            # Активные сессии пользователя по времени создания: список сессий,
+            # выход на всех устройствах и вытеснение самых старых при входе
+            models.Index(fields=['user', 'is_active', 'created_at'], name='sessiontoken_user_active_idx'),
+        ]
+    
+    @staticmethod
+    def hash_token(token_key):
+        # Медленный хэш не нужен: токен - 256 случайных бит, перебирать нечего
+        return hashlib.sha256(token_key.encode()).digest()
+    
+    @classmethod
+    def lookup(cls, token_key, token_hash=None):
+        # Условие поиска по предъявленному токену. Только на время перехода
+        # (SESSION_TOKEN_LEGACY_LOOKUP) в том же запросе проверяется и старая колонка
+        condition = Q(token_hash=token_hash or cls.hash_token(token_key))
+        if getattr(settings, 'SESSION_TOKEN_LEGACY_LOOKUP', False):
+            condition |= Q(token_hash__isnull=True, token=token_key)
+        return condition
+    
+    @classmethod
+    def from_key(cls, token_key, **fields):
+        # Открытый токен остается только в атрибуте key объекта - его
+        # один раз отдают клиенту
+        token = cls(token_hash=cls.hash_token(token_key), prefix=token_key[:8], **fields)
+        token.key = token_key
+        return token
+    
     @classmethod
     def generate_token(cls, user, duration_days=30):
-        token = secrets.token_hex(32)
-        expires_at = datetime.now() + timedelta(days=duration_days)
-        return cls.objects.create(
+        token = cls.from_key(
+            secrets.token_hex(32),
             user=user,
-            token=token,
-            expires_at=expires_at
+            expires_at=timezone.now() + timedelta(days=duration_days)
         )
+        token.save()
+        return token
     
     def is_valid(self):
         return self.is_active and timezone.now() < self.expires_at
\ No newline at end of file
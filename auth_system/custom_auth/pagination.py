@@ -0,0 +1,37 @@
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
+from rest_framework.decorators import action
+from rest_framework.pagination import CursorPagination
+
+
+class KeysetPagination(CursorPagination):
+    # Курсорная пагинация по первичному ключу: каждая страница - один запрос
+    # WHERE id > курсор ORDER BY id LIMIT n по индексу, без OFFSET и COUNT,
+    # поэтому глубокие страницы стоят столько же, сколько первая
+    ordering = 'id'
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+
+class NDJSONExportMixin:
+    # GET <prefix>/export/ отдает всю таблицу построчно в формате NDJSON.
+    # Строки читаются через values_list().iterator(chunk_size), без создания
+    # моделей и сериализаторов, поэтому память не зависит от размера таблицы.
+    # export_fields: {ключ в выводе: поле или lookup для values_list}
+    export_fields = None
+    export_chunk_size = 2000
+
+    @action(detail=False, methods=['get'])
+    def export(self, request):
+        names = list(self.export_fields)
+        rows = self.get_queryset().order_by('pk').values_list(*self.export_fields.values())
+        encoder = DjangoJSONEncoder()
+
+        def lines():
+            for row in rows.iterator(chunk_size=self.export_chunk_size):
+                yield encoder.encode(dict(zip(names, row))) + '\n'
+
+        response = StreamingHttpResponse(lines(), content_type='application/x-ndjson')
+        response['Content-Disposition'] = f'attachment; filename="{self.basename}.ndjson"'
+        return response
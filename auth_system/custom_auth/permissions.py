@@ -1,38 +1,35 @@
 from rest_framework import permissions
-from .models import Permission, Resource, UserRole
+from .cache import permission_cache
+from .instrumentation import stage
+from .resources import resource_index
+from .routers import replica_reads
 
 class CustomPermission(permissions.BasePermission):
     def has_permission(self, request, view):
-        # Суперпользователь имеет все права
-        if hasattr(request.user, 'is_superuser') and request.user.is_superuser:
-            return True
-        
-        # Получаем имя ресурса
+        with stage('permission'):
+            # Суперпользователь имеет все права
+            if hasattr(request.user, 'is_superuser') and request.user.is_superuser:
+                return True
+            
+            if not getattr(request.user, 'is_authenticated', False):
+                return False
+            
+            # Ресурс берется из заранее собранного индекса маршрутов, решение -
+            # из скомпилированной карты прав; на прогретом кеше проверка не делает
+            # запросов к БД. Для access-токена роли уже есть в его claims.
+            # Промах кеша читает из реплики, если она настроена
+            with replica_reads():
+                resource_ids = resource_index.get_resource_ids(
+                    view.__class__, getattr(view, 'action', None), request.method,
+                    self.get_dynamic_resource_name(request, view)
+                )
+                role_ids = getattr(request.auth, 'role_ids', None)
+                return permission_cache.is_allowed(request.user, resource_ids, role_ids)
+    
+    def get_dynamic_resource_name(self, request, view):
+        # Имя ресурса, заданное на запросе или вычисляемое view, имеет
+        # приоритет над индексом маршрутов
         resource_name = getattr(request, 'resource_name', None)
         if not resource_name and hasattr(view, 'get_resource_name'):
             resource_name = view.get_resource_name(request)
-        
-        if not resource_name:
-            # Если ресурс не указан, используем имя view + метод
-            resource_name = f"{view.__class__.__name__.lower()}_{request.method.lower()}"
-        
-        method = request.method
-        
-        try:
-            # Ищем ресурс в базе данных
-            resource = Resource.objects.get(name=resource_name, method=method)
-        except Resource.DoesNotExist:
-            # Если ресурс не найден, запрещаем доступ
-            return False
-        
-        # Получаем все роли пользователя
-        user_roles = UserRole.objects.filter(user=request.user).values_list('role_id', flat=True)
-        
-        # Проверяем, есть ли у любой из ролей пользователя доступ к ресурсу
-        has_access = Permission.objects.filter(
-            role_id__in=user_roles,
-            resource=resource,
-            can_access=True
-        ).exists()
-        
-        return has_access
\ No newline at end of file
+        return resource_name
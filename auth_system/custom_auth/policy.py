@@ -0,0 +1,306 @@
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+from bisect import bisect_left
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection, transaction
+
+from .models import Permission, Resource, UserEffectivePermission, UserRole
+
+logger = logging.getLogger('custom_auth.policy')
+
+# Формат файла (порядок байт платформы, файл собирается и читается на одном
+# хосте): заголовок, таблица секций (смещение, длина в байтах) и секции,
+# выровненные по 8 байт. Числовые секции - массивы int64, отсортированные
+# по ключу; таблица "ключ -> список" хранится как ids, offsets (len(ids) + 1)
+# и values, значения ключа ids[i] - values[offsets[i]:offsets[i + 1]].
+# resource_names - строки 'name\0method' подряд, границы в resource_keys.
+# При несовместимом изменении формата увеличивается FORMAT_VERSION
+MAGIC = b'CAPB'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('=4sIIQ')  # magic, версия формата, число секций, поколение
+SECTION = struct.Struct('=QQ')
+SECTIONS = (
+    'resource_ids', 'resource_keys', 'resource_names',
+    'role_ids', 'role_offsets', 'role_resources',
+    'user_ids', 'user_offsets', 'user_resources',
+    'user_role_ids', 'user_role_offsets', 'user_roles',
+)
+BATCH_SIZE = 5000
+CHANGED_KEY = 'custom_auth:policy_bundle:changed'
+# Сколько пользователей с локальными изменениями помнит PolicyStore; при
+# превышении снимок отключается целиком
+MAX_STALE_USERS = 10000
+
+
+class PolicyBundleError(ValueError):
+    pass
+
+
+def get_config():
+    config = {
+        'PATH': '',
+        'CHECK_INTERVAL': 1,
+        # Файл старше MAX_AGE секунд не используется (0 - без ограничения)
+        'MAX_AGE': getattr(settings, 'PERMISSION_CACHE_TTL', 60),
+        'CACHE_ALIAS': 'default',
+    }
+    config.update(getattr(settings, 'POLICY_BUNDLE', {}))
+    return config
+
+
+def _table(rows):
+    # Отсортированные пары (ключ, значение) -> ids, offsets, values
+    ids, offsets, values = array('q'), array('q'), array('q')
+    current = None
+    for key, value in rows:
+        if key != current:
+            ids.append(key)
+            offsets.append(len(values))
+            current = key
+        values.append(value)
+    offsets.append(len(values))
+    return ids, offsets, values
+
+
+def _contains(values, value):
+    index = bisect_left(values, value)
+    return index < len(values) and values[index] == value
+
+
+def build_policy(generation=None):
+    # Снимок Resource, Permission, UserRole (с предками ролей по RoleClosure)
+    # и UserEffectivePermission. Поколение берется до чтения: изменение,
+    # закоммиченное позже, не может оказаться старше файла
+    generation = generation or time.time_ns()
+    repeatable = connection.vendor == 'postgresql' and not connection.in_atomic_block
+    with transaction.atomic():
+        if repeatable:
+            # Все запросы снимка видят одно состояние базы
+            with connection.cursor() as cursor:
+                cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+
+        resource_ids, resource_keys, names = array('q'), array('q', [0]), bytearray()
+        for resource_id, name, method in Resource.objects.order_by('id').values_list('id', 'name', 'method'):
+            resource_ids.append(resource_id)
+            names += f'{name}\0{method}'.encode()
+            resource_keys.append(len(names))
+
+        roles = _table(
+            Permission.objects.filter(can_access=True)
+            .order_by('role_id', 'resource_id').values_list('role_id', 'resource_id')
+            .iterator(chunk_size=BATCH_SIZE)
+        )
+        users = _table(
+            UserEffectivePermission.objects.filter(can_access=True)
+            .order_by('user_id', 'resource_id').values_list('user_id', 'resource_id')
+            .iterator(chunk_size=BATCH_SIZE)
+        )
+        user_roles = _table(
+            UserRole.objects.order_by('user_id', 'role__ancestor_links__ancestor_id')
+            .values_list('user_id', 'role__ancestor_links__ancestor_id').distinct()
+            .iterator(chunk_size=BATCH_SIZE)
+        )
+
+    sections = [resource_ids, resource_keys, bytes(names), *roles, *users, *user_roles]
+    offset = HEADER.size + SECTION.size * len(SECTIONS)
+    table, body = [], bytearray()
+    for section in sections:
+        data = section.tobytes() if isinstance(section, array) else section
+        padding = -(offset + len(body)) % 8
+        body += b'\0' * padding
+        table.append((offset + len(body), len(data)))
+        body += data
+
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, len(SECTIONS), generation)
+    return header + b''.join(SECTION.pack(*entry) for entry in table) + bytes(body), {
+        'generation': generation,
+        'resources': len(resource_ids),
+        'roles': len(roles[0]),
+        'users': len(user_roles[0]),
+    }
+
+
+def write_policy(data, path):
+    # Атомарная замена: воркер видит либо старый файл целиком, либо новый.
+    # Уже открытый mmap продолжает читать старую версию до перечитывания
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def compile_policy(path=None):
+    path = path or get_config()['PATH']
+    started = time.perf_counter()
+    data, report = build_policy()
+    write_policy(data, path)
+    report.update(size=len(data), seconds=time.perf_counter() - started)
+    return report
+
+
+class PolicyBundle:
+    # Файл политики, отображенный в память только для чтения. Секции -
+    # memoryview над mmap, поиск - бинарный по ним без копирования, страницы
+    # файла в page cache общие для всех воркеров
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._mmap)
+        if len(view) < HEADER.size:
+            raise PolicyBundleError(f'{path}: truncated policy bundle')
+        magic, version, count, self.generation = HEADER.unpack_from(view)
+        if magic != MAGIC or version != FORMAT_VERSION or count != len(SECTIONS):
+            raise PolicyBundleError(f'{path}: unsupported policy bundle (version {version})')
+        if len(view) < HEADER.size + SECTION.size * count:
+            raise PolicyBundleError(f'{path}: truncated policy bundle')
+
+        for index, name in enumerate(SECTIONS):
+            offset, size = SECTION.unpack_from(view, HEADER.size + SECTION.size * index)
+            if offset % 8 or offset + size > len(view) or (name != 'resource_names' and size % 8):
+                raise PolicyBundleError(f'{path}: section {name} is out of bounds')
+            section = view[offset:offset + size]
+            setattr(self, name, section if name == 'resource_names' else section.cast('q'))
+
+    @staticmethod
+    def _lookup(ids, offsets, values, key):
+        index = bisect_left(ids, key)
+        if index < len(ids) and ids[index] == key:
+            return values[offsets[index]:offsets[index + 1]]
+        return None
+
+    def get_user_roles(self, user_id):
+        # None - пользователя нет в снимке (нет ролей или появился позже)
+        return self._lookup(self.user_role_ids, self.user_role_offsets, self.user_roles, user_id)
+
+    def is_allowed(self, user_id, resource_ids, role_ids=None):
+        # Та же логика, что у PermissionCache: без ролей из access-токена -
+        # разрешенные ресурсы пользователя, иначе - права этих ролей.
+        # None - решение по снимку невозможно
+        if role_ids is None:
+            if self.get_user_roles(user_id) is None:
+                return None
+            allowed = self._lookup(self.user_ids, self.user_offsets, self.user_resources, user_id)
+            return allowed is not None and any(_contains(allowed, resource_id) for resource_id in resource_ids)
+        for role_id in role_ids:
+            allowed = self._lookup(self.role_ids, self.role_offsets, self.role_resources, role_id)
+            if allowed is not None and any(_contains(allowed, resource_id) for resource_id in resource_ids):
+                return True
+        return False
+
+    def resource_rows(self):
+        # (id, name, method) для индекса ресурсов вместо запроса к Resource
+        keys = self.resource_keys
+        for index, resource_id in enumerate(self.resource_ids):
+            name, method = bytes(self.resource_names[keys[index]:keys[index + 1]]).decode().split('\0')
+            yield resource_id, name, method
+
+
+class PolicyStore:
+    # Текущий файл политики процесса. Не чаще раза в CHECK_INTERVAL секунд
+    # проверяет, не заменен ли файл (inode, mtime, размер), и отображает
+    # новую версию без перезапуска воркера. Локальные изменения прав
+    # (invalidate) и отметка об изменении в общем кеше от других процессов
+    # отключают снимок - целиком или для пользователей - до появления файла
+    # более нового поколения, до тех пор решения берутся из БД. Так же
+    # отключается файл старше MAX_AGE, если compile_policy --watch не запущен
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._bundle = None
+        self._stat = None
+        self._checked_at = None
+        self._stale_before = 0
+        self._stale_users = {}
+
+    def _reload(self, path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self._bundle = self._stat = None
+            return
+        key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if key == self._stat:
+            return
+        try:
+            bundle = PolicyBundle(path)
+        except (OSError, ValueError) as e:
+            logger.warning('Policy bundle is not loaded: %s', e)
+            bundle = None
+        else:
+            self._stale_users = {
+                user_id: changed for user_id, changed in self._stale_users.items() if changed >= bundle.generation
+            }
+        # Старый mmap освобождается, когда его перестанут использовать запросы
+        self._bundle, self._stat = bundle, key
+
+    def _check_changed(self, config):
+        # Изменение прав в другом процессе видно через отметку в общем кеше
+        changed = caches[config['CACHE_ALIAS']].get(CHANGED_KEY)
+        if changed is not None and changed > self._stale_before:
+            self._stale_before = changed
+
+    def get(self, user_id=None):
+        config = get_config()
+        if not config['PATH']:
+            return None
+        now = time.monotonic()
+        if self._checked_at is None or now - self._checked_at >= config['CHECK_INTERVAL']:
+            with self._lock:
+                if self._checked_at is None or now - self._checked_at >= config['CHECK_INTERVAL']:
+                    self._reload(config['PATH'])
+                    self._check_changed(config)
+                    self._checked_at = now
+        bundle = self._bundle
+        if bundle is None or bundle.generation <= self._stale_before:
+            return None
+        if config['MAX_AGE'] and time.time_ns() - bundle.generation > config['MAX_AGE'] * 1e9:
+            return None
+        if user_id is not None and bundle.generation <= self._stale_users.get(user_id, 0):
+            return None
+        return bundle
+
+    def invalidate(self, user_ids=None):
+        config = get_config()
+        if not config['PATH']:
+            return
+        changed = time.time_ns()
+        if user_ids is None:
+            self._stale_before = changed
+        else:
+            for user_id in user_ids:
+                self._stale_users[user_id] = changed
+            if len(self._stale_users) > MAX_STALE_USERS:
+                self._stale_before = changed
+                self._stale_users = {}
+        self._checked_at = None
+        # Отметка для compile_policy --watch в других процессах
+        caches[config['CACHE_ALIAS']].set(CHANGED_KEY, changed, None)
+
+    def stats(self):
+        bundle = self._bundle
+        return {
+            'generation': bundle.generation if bundle is not None else None,
+            'stale_users': len(self._stale_users),
+        }
+
+
+policy_store = PolicyStore()
+
+
+def policy_changed_at():
+    config = get_config()
+    return caches[config['CACHE_ALIAS']].get(CHANGED_KEY)
@@ -0,0 +1,113 @@
+import threading
+import time
+
+from django.conf import settings
+
+from .models import Resource
+from .policy import policy_store
+
+ALL_METHODS = '*'
+
+
+def resource_name_for(view_class, action, method):
+    # Имя ресурса для действия viewset: явное соответствие resource_names,
+    # общее resource_name или имя view + метод
+    resource_names = getattr(view_class, 'resource_names', None) or {}
+    if action in resource_names:
+        return resource_names[action]
+    resource_name = getattr(view_class, 'resource_name', None)
+    if resource_name:
+        return resource_name
+    return f"{view_class.__name__.lower()}_{method.lower()}"
+
+
+class ResourceIndex:
+    # Маршруты роутера (viewset, action, HTTP-метод), заранее сопоставленные
+    # с id ресурсов. Ресурс с методом '*' подходит для любого метода.
+    # Перестраивается сигналами при изменении Resource.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._routes = None
+        # (маршрутный индекс, ресурсы по (name, method)) меняются атомарно
+        self._state = None
+
+    def compile_routes(self, router=None):
+        # Маршруты известны без БД, их можно собрать при старте
+        if router is None:
+            from .urls import router
+        routes = {}
+        for prefix, viewset, basename in router.registry:
+            for route in router.get_routes(viewset):
+                for method, action in router.get_method_map(viewset, route.mapping).items():
+                    method = method.upper()
+                    routes[(viewset, action, method)] = resource_name_for(viewset, action, method)
+        self._routes = routes
+        return routes
+
+    def _resource_rows(self):
+        return Resource.objects.values_list('id', 'name', 'method')
+
+    def _bundle_rows(self):
+        # Ресурсы из файла политики, если он подключен и не устарел
+        bundle = policy_store.get()
+        return list(bundle.resource_rows()) if bundle is not None else None
+
+    def _store(self, rows):
+        resources = {}
+        for resource_id, name, method in rows:
+            resources.setdefault((name, method), []).append(resource_id)
+        routes = self._routes if self._routes is not None else self.compile_routes()
+        index = {
+            route: self._match(resources, name, route[2])
+            for route, name in routes.items()
+        }
+        self._state = (index, resources, time.monotonic())
+        return self._state
+
+    @staticmethod
+    def _match(resources, name, method):
+        return frozenset(resources.get((name, method), []) + resources.get((name, ALL_METHODS), []))
+
+    def _fresh_state(self):
+        # Тот же TTL, что и у кеша прав: изменения ресурсов в других
+        # процессах видны не позже PERMISSION_CACHE_TTL
+        state = self._state
+        ttl = getattr(settings, 'PERMISSION_CACHE_TTL', 60)
+        if state is not None and ttl and time.monotonic() - state[2] > ttl:
+            return None
+        return state
+
+    def _get_state(self):
+        state = self._fresh_state()
+        if state is None:
+            with self._lock:
+                state = self._fresh_state()
+                if state is None:
+                    rows = self._bundle_rows()
+                    state = self._store(self._resource_rows() if rows is None else rows)
+        return state
+
+    def _lookup(self, state, view_class, action, method, resource_name):
+        index, resources, loaded_at = state
+        if resource_name is None:
+            resource_ids = index.get((view_class, action, method))
+            if resource_ids is not None:
+                return resource_ids
+            resource_name = resource_name_for(view_class, action, method)
+        return self._match(resources, resource_name, method)
+
+    def get_resource_ids(self, view_class, action, method, resource_name=None):
+        # resource_name задается, когда имя ресурса вычисляется динамически
+        # и маршрутный индекс неприменим
+        return self._lookup(self._get_state(), view_class, action, method, resource_name)
+
+    def get_resources(self):
+        # {(name, method): [resource_id, ...]}
+        return self._get_state()[1]
+
+    def invalidate(self):
+        self._state = None
+
+
+resource_index = ResourceIndex()
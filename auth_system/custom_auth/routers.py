@@ -0,0 +1,99 @@
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import request_started
+from django.db import DEFAULT_DB_ALIAS
+from django.dispatch import receiver
+
+_replica_reads = ContextVar('custom_auth_replica_reads', default=False)
+_wrote = ContextVar('custom_auth_wrote', default=False)
+
+# Модели, из которых собирается решение о правах. После изменения прав
+# их чтение на PIN_SECONDS закрепляется за primary
+PERMISSION_MODELS = {'role', 'roleclosure', 'resource', 'permission', 'userrole', 'usereffectivepermission'}
+
+
+def get_config():
+    config = {
+        'ALIASES': [],
+        'PIN_SECONDS': 5,
+        'CACHE_ALIAS': 'default',
+    }
+    config.update(getattr(settings, 'AUTH_REPLICAS', {}))
+    return config
+
+
+@contextmanager
+def replica_reads():
+    # Внутри блока чтения custom_auth могут уйти в реплику: так помечены
+    # только поиск токена и проверка прав, остальной код читает из primary
+    token = _replica_reads.set(True)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+def replica_active():
+    return _replica_reads.get() and not _wrote.get() and bool(get_config()['ALIASES'])
+
+
+def _pin_key(scope, key):
+    return f'custom_auth:replica_pin:{scope}:{key}'
+
+
+def pin_primary(scope, key=''):
+    # Отметка в общем кеше видна всем воркерам: пока она жива, данные
+    # scope читаются из primary, даже если реплика еще отстает
+    config = get_config()
+    if config['ALIASES'] and config['PIN_SECONDS']:
+        caches[config['CACHE_ALIAS']].set(_pin_key(scope, key), True, config['PIN_SECONDS'])
+
+
+def is_pinned(scope, key=''):
+    config = get_config()
+    return bool(config['ALIASES']) and caches[config['CACHE_ALIAS']].get(_pin_key(scope, key)) is not None
+
+
+async def ais_pinned(scope, key=''):
+    config = get_config()
+    return bool(config['ALIASES']) and await caches[config['CACHE_ALIAS']].aget(_pin_key(scope, key)) is not None
+
+
+class AuthReplicaRouter:
+    # Чтения внутри replica_reads() распределяются по AUTH_REPLICAS['ALIASES'],
+    # все остальные чтения и любые записи идут в primary. Read-your-writes:
+    # - после записи остаток того же запроса читает из primary;
+    # - после logout, деактивации и изменения прав (см. signals) отметка
+    #   pin_primary на PIN_SECONDS отправляет соответствующие чтения в primary;
+    # - токен, которого еще нет в реплике, перечитывается из primary.
+
+    def db_for_read(self, model, **hints):
+        if not replica_active() or model._meta.app_label != 'custom_auth':
+            return DEFAULT_DB_ALIAS
+        if model._meta.model_name in PERMISSION_MODELS and is_pinned('permissions'):
+            return DEFAULT_DB_ALIAS
+        return random.choice(get_config()['ALIASES'])
+
+    def db_for_write(self, model, **hints):
+        # Явный alias нужен и для объектов, прочитанных из реплики:
+        # иначе Django сохранил бы их туда, откуда они загружены
+        _wrote.set(True)
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Реплики содержат те же строки, что и primary
+        databases = {DEFAULT_DB_ALIAS, *get_config()['ALIASES']}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+
+@receiver(request_started)
+def reset_write_pin(**kwargs):
+    # Под WSGI поток воркера переиспользуется, и отметка о записи
+    # не должна переходить в следующий запрос
+    _wrote.set(False)
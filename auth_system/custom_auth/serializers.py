@@ -1,5 +1,7 @@
+from django.core.exceptions import ValidationError as DjangoValidationError
 from rest_framework import serializers
-from .models import User, Role, UserRole, Resource, Permission
+from .models import User, Role, Resource, Permission, SessionToken
+from .hashing import hashing_pool
 
 class UserRegistrationSerializer(serializers.Serializer):
     email = serializers.EmailField()
@@ -24,9 +26,9 @@ class UserRegistrationSerializer(serializers.Serializer):
         password = validated_data.pop('password')
         validated_data.pop('password_repeat')
         
-        # Создаем пользователя
+        # Создаем пользователя; хэш считается в пуле хэширования
         user = User(**validated_data)
-        user.set_password(password)
+        user.password_hash = hashing_pool.make_password(password)
         user.save()
         return user
 
@@ -35,6 +37,14 @@ class UserProfileSerializer(serializers.ModelSerializer):
         model = User
         fields = ['id', 'email', 'first_name', 'last_name', 'patronymic', 'created_at', 'last_login']
         read_only_fields = ['id', 'email', 'created_at', 'last_login']
+    
+    def update(self, instance, validated_data):
+        # Записываются только измененные поля: остальные колонки (is_active,
+        # last_login из буфера входов) могли измениться в БД после загрузки
+        for field, value in validated_data.items():
+            setattr(instance, field, value)
+        instance.save(update_fields=[*validated_data, 'updated_at'])
+        return instance
 
 class UserLoginSerializer(serializers.Serializer):
     email = serializers.EmailField()
@@ -52,16 +62,72 @@ class UserLoginSerializer(serializers.Serializer):
         except User.DoesNotExist:
             raise serializers.ValidationError("Invalid credentials")
         
-        if not user.check_password(password):
+        # Пользователь нужен журналу входов и при неверном пароле
+        self.user = user
+        
+        # Проверка идет в пуле хэширования, устаревший хэш пересчитывается
+        if not hashing_pool.verify_user_password(user, password):
             raise serializers.ValidationError("Invalid credentials")
             
         data['user'] = user
         return data
 
+class SessionSerializer(serializers.ModelSerializer):
+    current = serializers.SerializerMethodField()
+    
+    class Meta:
+        model = SessionToken
+        fields = ['id', 'prefix', 'created_at', 'expires_at', 'current']
+    
+    def get_current(self, obj):
+        # Сессия, которой аутентифицирован текущий запрос
+        return obj.pk == self.context.get('session_id')
+
+class AuthorizationCheckSerializer(serializers.Serializer):
+    resource = serializers.CharField(max_length=100)
+    method = serializers.CharField(max_length=10)
+    
+    def validate_method(self, value):
+        return value.upper()
+
+class AuthorizeBatchSerializer(serializers.Serializer):
+    checks = serializers.ListField(child=AuthorizationCheckSerializer(), allow_empty=False, max_length=500)
+    # Для сервисных клиентов: проверить права нескольких пользователей
+    users = serializers.ListField(child=serializers.IntegerField(), required=False, allow_empty=False, max_length=100)
+
+class TokenRefreshSerializer(serializers.Serializer):
+    refresh_token = serializers.CharField()
+
+class PermissionGrantSerializer(serializers.Serializer):
+    role = serializers.IntegerField()
+    resource = serializers.IntegerField()
+    can_access = serializers.BooleanField(default=True)
+
+class UserRoleAssignmentSerializer(serializers.Serializer):
+    user = serializers.IntegerField()
+    role = serializers.IntegerField()
+
+class BulkItemsSerializer(serializers.Serializer):
+    # Элементы проверяются по одному в bulk: не-объект - ошибка своего
+    # элемента в results, а не 400 на весь пакет
+    items = serializers.ListField(child=serializers.JSONField(), allow_empty=False, max_length=10000)
+
 class RoleSerializer(serializers.ModelSerializer):
     class Meta:
         model = Role
         fields = '__all__'
+    
+    def validate(self, data):
+        # Проверка цикла в иерархии ролей (Role.clean) до сохранения
+        role = Role(
+            pk=self.instance.pk if self.instance else None,
+            parent=data.get('parent', self.instance.parent if self.instance else None)
+        )
+        try:
+            role.clean()
+        except DjangoValidationError as e:
+            raise serializers.ValidationError(e.message_dict)
+        return data
 
 class ResourceSerializer(serializers.ModelSerializer):
     class Meta:
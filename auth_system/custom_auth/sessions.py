@@ -0,0 +1,80 @@
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .cache import get_token_cache
+from .models import SessionToken, User
+from .routers import pin_primary
+from .tokens import revoke_session, revoke_user
+
+
+def active_sessions(user_id):
+    # Индекс (user, is_active, created_at): список без сортировки в памяти
+    return SessionToken.objects.filter(
+        user_id=user_id, is_active=True, expires_at__gt=timezone.now()
+    ).order_by('-created_at', '-id')
+
+
+def _after_deactivation(user_id, tokens):
+    # update() не отправляет сигналы: кеш токенов, access-токены сессий и
+    # чтения с реплики обрабатываются здесь, сразу и после коммита
+    def invalidate():
+        token_cache = get_token_cache()
+        for session_id, token_hash in tokens:
+            if token_hash is not None:
+                token_cache.evict(token_hash)
+            revoke_session(session_id)
+        pin_primary('user', user_id)
+    invalidate()
+    transaction.on_commit(invalidate)
+
+
+def end_sessions(user_id, session_ids):
+    with transaction.atomic():
+        tokens = list(
+            SessionToken.objects.filter(user_id=user_id, is_active=True, pk__in=session_ids)
+            .values_list('id', 'token_hash')
+        )
+        SessionToken.objects.filter(pk__in=[session_id for session_id, _ in tokens]).update(is_active=False)
+        _after_deactivation(user_id, tokens)
+    return len(tokens)
+
+
+def end_all_sessions(user_id):
+    # Выход на всех устройствах: одно UPDATE по индексу вместо обхода токенов.
+    # Закешированные токены отсекает отметка отзыва в кеше токенов,
+    # access-токены - отметка revoke_user
+    count = SessionToken.objects.filter(user_id=user_id, is_active=True).update(is_active=False)
+
+    def invalidate():
+        get_token_cache().revoke_user(user_id)
+        revoke_user(user_id)
+        pin_primary('user', user_id)
+    invalidate()
+    transaction.on_commit(invalidate)
+    return count
+
+
+def start_session(user):
+    # Новый токен и вытеснение самых старых сверх MAX_SESSIONS_PER_USER в
+    # одной транзакции. Блокировка строки пользователя упорядочивает
+    # одновременные входы в один аккаунт, поэтому активных токенов никогда
+    # не становится больше лимита
+    limit = getattr(settings, 'MAX_SESSIONS_PER_USER', 0)
+    with transaction.atomic():
+        # В SQLite select_for_update не блокирует, а чтение перед записью в
+        # параллельных транзакциях дает "database is locked". Там
+        # упорядочивает вставка токена: первая запись берет блокировку базы
+        # до конца транзакции, остальные входы ждут ее (timeout соединения)
+        if limit and connection.vendor != 'sqlite':
+            list(User.objects.select_for_update().filter(pk=user.pk).values_list('pk'))
+        token = SessionToken.generate_token(user)
+        if limit:
+            stale = list(
+                SessionToken.objects.filter(user_id=user.pk, is_active=True)
+                .order_by('-created_at', '-id')
+                .values_list('id', flat=True)[limit:]
+            )
+            if stale:
+                end_sessions(user.pk, stale)
+    return token
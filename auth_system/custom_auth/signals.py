@@ -0,0 +1,111 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .cache import get_token_cache, permission_cache
+from .effective import refresh_effective_permissions
+from .hierarchy import descendant_users, rebuild_role_closure
+from .models import Permission, Resource, Role, SessionToken, User, UserRole
+from .resources import resource_index
+from .routers import pin_primary
+
+
+def _on_commit(func, *args):
+    # Сбрасываем сразу и еще раз после коммита, чтобы параллельный запрос
+    # не успел закешировать данные незакоммиченной транзакции
+    func(*args)
+    transaction.on_commit(lambda: func(*args))
+
+
+@receiver(post_save, sender=Resource)
+@receiver(post_delete, sender=Resource)
+def invalidate_resource_index(sender, **kwargs):
+    _on_commit(resource_index.invalidate)
+
+
+@receiver(post_save, sender=Role)
+@receiver(post_delete, sender=Role)
+@receiver(post_save, sender=Resource)
+@receiver(post_delete, sender=Resource)
+@receiver(post_save, sender=Permission)
+@receiver(post_delete, sender=Permission)
+def invalidate_permission_cache(sender, **kwargs):
+    _on_commit(permission_cache.invalidate)
+
+
+@receiver(post_save, sender=UserRole)
+@receiver(post_delete, sender=UserRole)
+def invalidate_user_roles(sender, instance, **kwargs):
+    _on_commit(permission_cache.invalidate_user, instance.user_id)
+
+
+@receiver(pre_save, sender=Role)
+def check_role_hierarchy(sender, instance, raw=False, **kwargs):
+    # Цикл в иерархии отклоняется до записи, в том числе в обход сериализатора
+    if not raw:
+        instance.clean()
+
+
+@receiver(post_save, sender=Role)
+@receiver(post_delete, sender=Role)
+def refresh_role_closure(sender, **kwargs):
+    # Пользователи ролей, у которых сменились предки, получают новый набор прав
+    changed = rebuild_role_closure()
+    if changed:
+        refresh_effective_permissions(user_ids=UserRole.objects.filter(role_id__in=changed).values('user_id'))
+
+
+# UserEffectivePermission обновляется в той же транзакции, что и изменение:
+# для UserRole - все права пользователя, для Permission - один ресурс у
+# пользователей роли. Удаление роли или ресурса каскадом вызывает те же сигналы
+@receiver(post_save, sender=UserRole)
+@receiver(post_delete, sender=UserRole)
+def refresh_user_permissions(sender, instance, **kwargs):
+    refresh_effective_permissions(user_ids=[instance.user_id])
+
+
+@receiver(post_save, sender=Permission)
+@receiver(post_delete, sender=Permission)
+def refresh_resource_permissions(sender, instance, **kwargs):
+    refresh_effective_permissions(user_ids=descendant_users([instance.role_id]), resource_ids=[instance.resource_id])
+
+
+@receiver(post_save, sender=SessionToken)
+@receiver(post_delete, sender=SessionToken)
+def evict_session_token(sender, instance, **kwargs):
+    # logout и любое изменение токена убирают его из кеша. У строки, еще не
+    # перехэшированной rehash_tokens, ключ кеша считается по открытому токену
+    token_hash = instance.token_hash or (instance.token and SessionToken.hash_token(instance.token))
+    if token_hash:
+        _on_commit(get_token_cache().evict, token_hash)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def evict_user_tokens(sender, instance, **kwargs):
+    # Деактивация (в том числе delete_account) и изменение профиля делают
+    # недействительными все закешированные токены пользователя
+    _on_commit(get_token_cache().evict_user, instance.pk)
+
+
+# Реплика может отставать: после изменения прав, logout, выдачи токена или
+# деактивации пользователя соответствующие чтения на AUTH_REPLICAS['PIN_SECONDS']
+# идут в primary (без настроенных реплик receiver ничего не делает)
+@receiver(post_save, sender=Role)
+@receiver(post_delete, sender=Role)
+@receiver(post_save, sender=Resource)
+@receiver(post_delete, sender=Resource)
+@receiver(post_save, sender=Permission)
+@receiver(post_delete, sender=Permission)
+@receiver(post_save, sender=UserRole)
+@receiver(post_delete, sender=UserRole)
+def pin_permission_reads(sender, **kwargs):
+    _on_commit(pin_primary, 'permissions')
+
+
+@receiver(post_save, sender=SessionToken)
+@receiver(post_delete, sender=SessionToken)
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def pin_user_reads(sender, instance, **kwargs):
+    _on_commit(pin_primary, 'user', instance.user_id if sender is SessionToken else instance.pk)
@@ -0,0 +1,444 @@
+import io
+import json
+import os
+import tempfile
+from datetime import timedelta
+from time import time_ns
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import caches
+from django.core.exceptions import ValidationError
+from django.db import DatabaseError, connection
+from django.db.models.signals import post_delete
+from django.test import AsyncClient, RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from . import imports
+from .checks import check_revocation_cache
+from .cache import PermissionCache, reset_token_cache
+from .maintenance import reap_session_tokens
+from .middleware import AuthMiddleware
+from .models import Permission, Resource, Role, SessionToken, User, UserEffectivePermission, UserRole
+from .policy import CHANGED_KEY, PolicyStore, compile_policy
+
+
+# Вход без ограничения частоты и с записью учета входов в потоке запроса,
+# чтобы фоновый поток не писал в БД вне транзакции теста
+@override_settings(
+    LOGIN_THROTTLE={'RATES': {'email': '1000/min', 'ip': '1000/min'}},
+    LOGIN_BUFFER={'FLUSH_INTERVAL': 0},
+)
+class AuthTestCase(TestCase):
+    password = 'secret123'
+
+    def setUp(self):
+        # Общий кеш и локальный LRU кеша токенов не переносят записи между тестами
+        caches['default'].clear()
+        reset_token_cache(setting='TOKEN_CACHE')
+        self.user = User(email='user@example.com')
+        self.user.set_password(self.password)
+        self.user.save()
+        self.client = APIClient()
+
+    def login(self):
+        response = self.client.post('/api/auth/login/', {'email': self.user.email, 'password': self.password})
+        self.assertEqual(response.status_code, 200)
+        return response.json()['token']
+
+    def get(self, path, token):
+        return self.client.get(path, HTTP_AUTHORIZATION=f'Bearer {token}')
+
+
+class SessionRevocationTests(AuthTestCase):
+    def test_logout_all_survives_next_login(self):
+        # Запись пользователя в кеше токенов восстанавливается при новом
+        # входе; токены, отозванные раньше, не должны снова приниматься
+        old_token = self.login()
+        self.assertEqual(self.get('/api/auth/profile/', old_token).status_code, 200)
+
+        response = self.client.post('/api/auth/sessions/logout_all/', HTTP_AUTHORIZATION=f'Bearer {old_token}')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(self.get('/api/auth/profile/', old_token).status_code, (401, 403))
+
+        new_token = self.login()
+        self.assertEqual(self.get('/api/auth/profile/', new_token).status_code, 200)
+        self.assertIn(self.get('/api/auth/profile/', old_token).status_code, (401, 403))
+
+
+# Без кеша токенов каждый запрос ищет токен в БД: AuthMiddleware и
+# SessionTokenAuthentication должны делить один поиск
+@override_settings(TOKEN_CACHE={'BACKEND': 'custom_auth.cache.BaseTokenCache'})
+class TokenLookupTests(AuthTestCase):
+    requests = 5
+
+    def setUp(self):
+        super().setUp()
+        self.token = SessionToken.generate_token(self.user)
+
+    def token_lookups(self, captured):
+        table = SessionToken._meta.db_table
+        return sum(table in query['sql'] for query in captured)
+
+    def test_one_lookup_per_wsgi_request(self):
+        with CaptureQueriesContext(connection) as captured:
+            for _ in range(self.requests):
+                self.assertEqual(self.get('/api/auth/profile/', self.token.key).status_code, 200)
+        self.assertEqual(self.token_lookups(captured), self.requests)
+
+    def test_one_lookup_per_asgi_request(self):
+        client = AsyncClient()
+
+        async def run():
+            for _ in range(self.requests):
+                response = await client.get('/api/auth/profile/', headers={'Authorization': f'Bearer {self.token.key}'})
+                self.assertEqual(response.status_code, 200)
+
+        with CaptureQueriesContext(connection) as captured:
+            async_to_sync(run)()
+        self.assertEqual(self.token_lookups(captured), self.requests)
+
+
+class ReapTokensTests(AuthTestCase):
+    def test_reap_deletes_expired_and_inactive_without_signals(self):
+        active = SessionToken.generate_token(self.user)
+        expired = SessionToken.generate_token(self.user)
+        inactive = SessionToken.generate_token(self.user)
+        SessionToken.objects.filter(id=expired.id).update(expires_at=timezone.now() - timedelta(days=1))
+        SessionToken.objects.filter(id=inactive.id).update(is_active=False)
+
+        # Пачка удаляется одним DELETE, post_delete на каждую строку не шлется
+        deleted = []
+        receiver = lambda sender, instance, **kwargs: deleted.append(instance.pk)
+        post_delete.connect(receiver, sender=SessionToken)
+        try:
+            report = reap_session_tokens(batch_size=1, sleep=0)
+        finally:
+            post_delete.disconnect(receiver, sender=SessionToken)
+
+        self.assertEqual(report['deleted'], 2)
+        self.assertEqual(deleted, [])
+        self.assertEqual(list(SessionToken.objects.values_list('id', flat=True)), [active.id])
+
+
+class PermissionCacheTests(AuthTestCase):
+    def test_user_entries_are_bounded(self):
+        cache = PermissionCache(ttl=60, max_users=2)
+        users = [User.objects.create(email=f'user{index}@example.com') for index in range(3)]
+        for user in users:
+            cache.get_user_roles(user.pk)
+            cache.get_user_resources(user.pk)
+        self.assertEqual(cache.stats()['cached_users'], 2)
+
+        # Вытеснен самый давний пользователь, остальные берутся из кеша
+        with self.assertNumQueries(1):
+            cache.get_user_resources(users[0].pk)
+        with self.assertNumQueries(0):
+            cache.get_user_resources(users[2].pk)
+
+
+class ProfileUpdateTests(AuthTestCase):
+    def test_put_keeps_columns_changed_after_caching(self):
+        token = self.login()
+        self.assertEqual(self.get('/api/auth/profile/', token).status_code, 200)
+
+        # Сброс буфера входов после того, как пользователь попал в кеш токенов
+        last_login = timezone.now() + timedelta(minutes=1)
+        User.objects.filter(pk=self.user.pk).update(last_login=last_login)
+
+        response = self.client.put(
+            '/api/auth/profile/', {'first_name': 'Ivan'}, HTTP_AUTHORIZATION=f'Bearer {token}'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.first_name, 'Ivan')
+        self.assertEqual(self.user.last_login, last_login)
+
+
+class RoleAssignmentTests(AuthTestCase):
+    def setUp(self):
+        super().setUp()
+        self.admin = Role.objects.create(name='admin')
+        self.manager = Role.objects.create(name='manager')
+        resource = Resource.objects.create(name='role_assignment', method='POST')
+        Permission.objects.create(role=self.manager, resource=resource, can_access=True)
+        UserRole.objects.create(user=self.user, role=self.manager)
+        self.other = User.objects.create(email='other@example.com')
+
+    def assign(self, token, *items):
+        return self.client.post(
+            '/api/admin/roles/assign/', {'items': list(items)}, format='json',
+            HTTP_AUTHORIZATION=f'Bearer {token}',
+        )
+
+    def test_cannot_assign_role_not_held(self):
+        response = self.assign(
+            self.login(),
+            {'user': self.user.pk, 'role': self.admin.pk},
+            {'user': self.other.pk, 'role': self.manager.pk},
+        )
+        self.assertEqual(response.status_code, 200)
+        statuses = [result['status'] for result in response.json()['results']]
+        self.assertEqual(statuses, ['error', 'created'])
+        self.assertFalse(UserRole.objects.filter(user=self.user, role=self.admin).exists())
+        self.assertTrue(UserRole.objects.filter(user=self.other, role=self.manager).exists())
+
+    def test_malformed_item_is_a_per_item_error(self):
+        response = self.assign(self.login(), {'user': self.other.pk, 'role': self.manager.pk}, 'junk')
+        self.assertEqual(response.status_code, 200)
+        statuses = [result['status'] for result in response.json()['results']]
+        self.assertEqual(statuses, ['created', 'error'])
+        self.assertTrue(UserRole.objects.filter(user=self.other, role=self.manager).exists())
+
+    def test_role_management_does_not_allow_assign(self):
+        # Право на изменение ролей не дает права их назначать
+        UserRole.objects.filter(user=self.user).delete()
+        role_management = Resource.objects.create(name='role_management', method='POST')
+        editor = Role.objects.create(name='editor')
+        Permission.objects.create(role=editor, resource=role_management, can_access=True)
+        UserRole.objects.create(user=self.user, role=editor)
+
+        response = self.assign(self.login(), {'user': self.user.pk, 'role': editor.pk})
+        self.assertEqual(response.status_code, 403)
+
+
+class AuthMiddlewareTests(AuthTestCase):
+    def run_middleware(self, **headers):
+        request = RequestFactory().get('/api/projects/', **headers)
+        request.user = AnonymousUser()
+        return AuthMiddleware(lambda request: request.user)(request)
+
+    def test_keeps_anonymous_user_without_valid_token(self):
+        # Обычные view и контекст-процессоры читают request.user.is_authenticated
+        self.assertFalse(self.run_middleware().is_authenticated)
+        self.assertFalse(self.run_middleware(HTTP_AUTHORIZATION='Bearer invalid').is_authenticated)
+
+    def test_sets_user_for_valid_token(self):
+        token = SessionToken.generate_token(self.user)
+        self.assertEqual(self.run_middleware(HTTP_AUTHORIZATION=f'Bearer {token.key}').pk, self.user.pk)
+
+
+class PolicyStoreTests(AuthTestCase):
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'policy.bin')
+        UserRole.objects.create(user=self.user, role=Role.objects.create(name='user'))
+        compile_policy(self.path)
+
+    def config(self, **options):
+        return override_settings(POLICY_BUNDLE={'PATH': self.path, 'CHECK_INTERVAL': 0, **options})
+
+    def test_bundle_expires_after_max_age(self):
+        # Без compile_policy --watch файл не обновляется: по истечении
+        # MAX_AGE права снова берутся из БД
+        store = PolicyStore()
+        with self.config(MAX_AGE=60):
+            self.assertIsNotNone(store.get(self.user.pk))
+            with mock.patch('custom_auth.policy.time.time_ns', return_value=time_ns() + 61 * 10 ** 9):
+                self.assertIsNone(store.get(self.user.pk))
+
+    def test_change_mark_from_other_process_disables_bundle(self):
+        store = PolicyStore()
+        with self.config():
+            self.assertIsNotNone(store.get(self.user.pk))
+            caches['default'].set(CHANGED_KEY, time_ns(), None)
+            self.assertIsNone(store.get(self.user.pk))
+            compile_policy(self.path)
+            self.assertIsNotNone(store.get(self.user.pk))
+
+    def test_stale_users_are_capped(self):
+        store = PolicyStore()
+        with self.config(), mock.patch('custom_auth.policy.MAX_STALE_USERS', 2):
+            store.invalidate([1, 2, 3])
+            self.assertEqual(store.stats()['stale_users'], 0)
+            self.assertIsNone(store.get(self.user.pk))
+
+
+@override_settings(PASSWORD_HASHING={'EXECUTOR': 'inline'})
+class ImportUsersTests(AuthTestCase):
+    rows = 'email,password\nfirst@example.com,secret123\nsecond@example.com,secret123\n'
+
+    def setUp(self):
+        super().setUp()
+        User.objects.filter(pk=self.user.pk).update(is_superuser=True)
+        self.token = self.login()
+
+    def post(self, body, query='', **extra):
+        response = self.client.generic(
+            'POST', f'/api/admin/users/import/{query}', body, content_type='text/csv',
+            HTTP_AUTHORIZATION=f'Bearer {self.token}', **extra,
+        )
+        self.assertEqual(response.status_code, 200)
+        return [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+
+    def test_invalid_rows_are_reported_per_row(self):
+        body = 'email,password\nnot-an-email,secret123\nshort@example.com,123\nok@example.com,secret123\n'
+        reports = self.post(body)
+        self.assertEqual(reports[-1]['totals'], {'created': 1, 'existing': 0, 'errors': 2})
+        self.assertEqual([error['row'] for error in reports[0]['errors']], [0, 1])
+        self.assertEqual(set(reports[0]['errors'][0]['errors']), {'email'})
+        self.assertEqual(set(reports[0]['errors'][1]['errors']), {'password'})
+        self.assertTrue(User.objects.filter(email='ok@example.com').exists())
+
+    def test_chunked_upload_without_content_length(self):
+        # Как у сервера с Transfer-Encoding: chunked: длины нет, wsgi.input читается до конца
+        reports = self.post(self.rows, CONTENT_LENGTH='', **{'wsgi.input': io.BytesIO(self.rows.encode())})
+        self.assertEqual(reports[-1]['totals']['created'], 2)
+
+    def test_failed_batch_ends_stream_with_error_record(self):
+        insert = imports._insert
+
+        def fail_second_batch(batch):
+            if batch[0][1].email == 'second@example.com':
+                raise DatabaseError('connection lost')
+            return insert(batch)
+
+        with mock.patch('custom_auth.imports._insert', side_effect=fail_second_batch), \
+                self.assertLogs('custom_auth.views', 'ERROR'):
+            reports = self.post(self.rows, '?batch_size=1')
+        self.assertEqual(reports[0]['created'], 1)
+        self.assertEqual(reports[-1], {'error': 'Import failed', 'offset': 1})
+        self.assertFalse(User.objects.filter(email='second@example.com').exists())
+
+
+class RevocationCacheCheckTests(AuthTestCase):
+    def caches_setting(self, backend):
+        return override_settings(CACHES={'default': {'BACKEND': f'django.core.cache.backends.{backend}'}})
+
+    def test_process_local_cache_is_reported(self):
+        with self.caches_setting('locmem.LocMemCache'), override_settings(DEBUG=False):
+            self.assertEqual([error.id for error in check_revocation_cache(None)], ['custom_auth.W001'])
+        with self.caches_setting('dummy.DummyCache'):
+            self.assertEqual([error.id for error in check_revocation_cache(None)], ['custom_auth.E001'])
+
+    def test_shared_cache_passes(self):
+        with self.caches_setting('redis.RedisCache'), override_settings(DEBUG=False):
+            self.assertEqual(check_revocation_cache(None), [])
+
+
+class LoginThrottleTests(AuthTestCase):
+    @override_settings(LOGIN_THROTTLE={'RATES': {'email': '2/min'}})
+    def test_excess_attempts_get_429_with_retry_after(self):
+        for _ in range(2):
+            response = self.client.post('/api/auth/login/', {'email': self.user.email, 'password': 'wrong'})
+            self.assertEqual(response.status_code, 400)
+        response = self.client.post('/api/auth/login/', {'email': self.user.email, 'password': self.password})
+        self.assertEqual(response.status_code, 429)
+        self.assertGreater(int(response['Retry-After']), 0)
+
+        # Лимит считается по email, другой аккаунт входит
+        other = User(email='other@example.com')
+        other.set_password(self.password)
+        other.save()
+        response = self.client.post('/api/auth/login/', {'email': other.email, 'password': self.password})
+        self.assertEqual(response.status_code, 200)
+
+
+class RoleHierarchyTests(AuthTestCase):
+    def test_cycle_is_rejected(self):
+        parent = Role.objects.create(name='parent')
+        child = Role.objects.create(name='child', parent=parent)
+        parent.parent = child
+        with self.assertRaises(ValidationError):
+            parent.save()
+
+        User.objects.filter(pk=self.user.pk).update(is_superuser=True)
+        response = self.client.patch(
+            f'/api/admin/roles/{parent.pk}/', {'parent': parent.pk}, format='json',
+            HTTP_AUTHORIZATION=f'Bearer {self.login()}',
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('parent', response.json())
+        parent.refresh_from_db()
+        self.assertIsNone(parent.parent_id)
+
+
+class BulkGrantTests(AuthTestCase):
+    def test_per_item_results_and_effective_permissions(self):
+        User.objects.filter(pk=self.user.pk).update(is_superuser=True)
+        role = Role.objects.create(name='user')
+        member = User.objects.create(email='member@example.com')
+        UserRole.objects.create(user=member, role=role)
+        resource = Resource.objects.create(name='project_list', method='GET')
+
+        def grant(can_access):
+            response = self.client.post('/api/admin/permissions/bulk/', {'items': [
+                {'role': role.pk, 'resource': resource.pk, 'can_access': can_access},
+                {'role': 0, 'resource': resource.pk, 'can_access': can_access},
+            ]}, format='json', HTTP_AUTHORIZATION=f'Bearer {token}')
+            self.assertEqual(response.status_code, 200)
+            return [result['status'] for result in response.json()['results']]
+
+        token = self.login()
+        self.assertEqual(grant(True), ['created', 'error'])
+        self.assertTrue(UserEffectivePermission.objects.filter(user=member, resource=resource, can_access=True).exists())
+
+        self.assertEqual(grant(False), ['updated', 'error'])
+        self.assertFalse(UserEffectivePermission.objects.filter(user=member, resource=resource, can_access=True).exists())
+
+
+class AccessPolicyTestCase(AuthTestCase):
+    # Роль user с доступом только к списку проектов
+    def setUp(self):
+        super().setUp()
+        self.role = Role.objects.create(name='user')
+        UserRole.objects.create(user=self.user, role=self.role)
+        project_list = Resource.objects.create(name='project_list', method='GET')
+        Resource.objects.create(name='project_create', method='POST')
+        Permission.objects.create(role=self.role, resource=project_list, can_access=True)
+        self.token = self.login()
+
+
+class AuthorizeBatchTests(AccessPolicyTestCase):
+    def authorize(self, **data):
+        checks = [{'resource': 'project_list', 'method': 'GET'}, {'resource': 'project_create', 'method': 'POST'}]
+        return self.client.post(
+            '/api/auth/authorize/batch/', {'checks': checks, **data}, format='json',
+            HTTP_AUTHORIZATION=f'Bearer {self.token}',
+        )
+
+    def test_decisions_for_current_user(self):
+        response = self.authorize()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([result['allowed'] for result in response.json()['results']], [True, False])
+
+    def test_other_users_need_authorization_check(self):
+        other = User.objects.create(email='other@example.com')
+        self.assertEqual(self.authorize(users=[other.pk]).status_code, 403)
+
+
+class ForwardAuthTests(AccessPolicyTestCase):
+    def verify(self, method, token=None):
+        headers = {'HTTP_X_ORIGINAL_METHOD': method, 'HTTP_X_ORIGINAL_URI': '/api/projects/?page=2'}
+        if token:
+            headers['HTTP_AUTHORIZATION'] = f'Bearer {token}'
+        return self.client.get('/auth/verify', **headers)
+
+    def test_allowed_request_gets_user_headers(self):
+        response = self.verify('GET', self.token)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Auth-User-Id'], str(self.user.pk))
+        self.assertEqual(response['X-Auth-Roles'], 'user')
+
+    def test_missing_or_invalid_token_is_401(self):
+        self.assertEqual(self.verify('GET').status_code, 401)
+        self.assertEqual(self.verify('GET', 'invalid').status_code, 401)
+
+    def test_forbidden_request_is_403(self):
+        self.assertEqual(self.verify('POST', self.token).status_code, 403)
+
+
+class AccessTokenTests(AuthTestCase):
+    def test_logout_revokes_issued_access_tokens(self):
+        response = self.client.post('/api/auth/login/', {'email': self.user.email, 'password': self.password})
+        session_token, access_token = response.json()['token'], response.json()['access_token']
+        self.assertEqual(self.get('/api/auth/profile/', access_token).status_code, 200)
+
+        response = self.client.post('/api/auth/logout/', HTTP_AUTHORIZATION=f'Bearer {session_token}')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(self.get('/api/auth/profile/', access_token).status_code, (401, 403))
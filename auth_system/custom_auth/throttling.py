@@ -0,0 +1,118 @@
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.dispatch import receiver
+from django.test.signals import setting_changed
+from rest_framework.throttling import BaseThrottle
+
+from .cache import LocalLRUCache
+
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_rate(rate):
+    # '5/min' -> (5, 60); None или '' отключает ограничение
+    if not rate:
+        return None
+    count, period = rate.split('/')
+    return int(count), PERIODS[period[0]]
+
+
+class GCRALimiter:
+    # Generic Cell Rate Algorithm: на ключ хранится одно число - теоретическое
+    # время прихода следующей попытки (TAT). Проверка - O(1) по времени и
+    # памяти, окно скользящее, допускается всплеск до count попыток.
+    # Состояние лежит в локальном LRU фиксированного размера или, если задан
+    # cache_alias, в общем кеше Django (чтение и запись не атомарны, при гонке
+    # лишними могут пройти единичные попытки).
+
+    def __init__(self, name, count, period, local_max_size=100000, cache_alias=None, key_prefix='custom_auth'):
+        self.name = name
+        self.interval = period / count
+        self.tolerance = period - self.interval
+        self.cache_alias = cache_alias
+        self.key_prefix = key_prefix
+        self.local = LocalLRUCache(local_max_size, period)
+        self._lock = threading.Lock()
+
+    def _key(self, value):
+        digest = hashlib.sha256(value.encode()).hexdigest()
+        return f'{self.key_prefix}:throttle:{self.name}:{digest}'
+
+    def _get(self, key):
+        if self.cache_alias:
+            return caches[self.cache_alias].get(key)
+        return self.local.get(key)
+
+    def _set(self, key, tat, ttl):
+        if self.cache_alias:
+            caches[self.cache_alias].set(key, tat, ttl)
+        else:
+            self.local.set(key, tat, ttl)
+
+    def hit(self, value, now=None):
+        # Возвращает 0, если попытка разрешена (и учитывает ее),
+        # иначе - сколько секунд ждать
+        now = time.time() if now is None else now
+        key = self._key(value)
+        with self._lock:
+            tat = max(self._get(key) or now, now)
+            wait = tat - self.tolerance - now
+            if wait > 0:
+                return wait
+            tat += self.interval
+            self._set(key, tat, max(int(tat - now) + 1, 1))
+        return 0
+
+
+class LoginThrottle(BaseThrottle):
+    # Ограничение попыток входа по email и по IP. Проверка идет в
+    # APIView.initial(), то есть до поиска пользователя и PBKDF2
+
+    def allow_request(self, request, view):
+        limiters = get_login_limiters()
+        values = {'ip': self.get_ident(request)}
+        email = request.data.get('email') if hasattr(request.data, 'get') else None
+        if isinstance(email, str) and email:
+            values['email'] = email.strip().lower()
+
+        self.wait_seconds = 0
+        for name, value in values.items():
+            limiter = limiters.get(name)
+            if limiter is not None:
+                self.wait_seconds = max(self.wait_seconds, limiter.hit(value))
+        return not self.wait_seconds
+
+    def wait(self):
+        return self.wait_seconds
+
+
+_login_limiters = None
+
+
+def get_login_limiters():
+    global _login_limiters
+    if _login_limiters is None:
+        config = {
+            'RATES': {'email': '5/min', 'ip': '30/min'},
+            'LOCAL_MAX_SIZE': 100000,
+            'CACHE_ALIAS': None,
+        }
+        config.update(getattr(settings, 'LOGIN_THROTTLE', {}))
+        limiters = {}
+        for name, rate in config['RATES'].items():
+            parsed = parse_rate(rate)
+            if parsed:
+                limiters[name] = GCRALimiter(name, *parsed, config['LOCAL_MAX_SIZE'], config['CACHE_ALIAS'])
+        _login_limiters = limiters
+    return _login_limiters
+
+
+@receiver(setting_changed)
+def reset_login_limiters(setting, **kwargs):
+    global _login_limiters
+    if setting == 'LOGIN_THROTTLE':
+        _login_limiters = None
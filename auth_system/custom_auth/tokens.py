@@ -0,0 +1,130 @@
+import time
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import caches
+
+from .models import User
+
+ACCESS_TOKEN_SALT = 'custom_auth.access_token'
+REVOKED_SESSION_KEY = 'custom_auth:revoked:session:{}'
+REVOKED_USER_KEY = 'custom_auth:revoked:user:{}'
+
+
+class AccessTokenError(Exception):
+    pass
+
+
+class AccessToken:
+    # Короткоживущий подписанный (HMAC) токен доступа. Проверяется в памяти
+    # процесса без обращения к БД; SessionToken, из которого он выпущен,
+    # служит refresh-токеном.
+
+    def __init__(self, claims):
+        self.claims = claims
+
+    @property
+    def user_id(self):
+        return self.claims['uid']
+
+    @property
+    def is_superuser(self):
+        return self.claims['su']
+
+    @property
+    def role_ids(self):
+        return frozenset(self.claims['roles'])
+
+    @property
+    def session_id(self):
+        return self.claims['sid']
+
+    @property
+    def expires_at(self):
+        return self.claims['exp']
+
+    @staticmethod
+    def is_access_token(value):
+        # Сессионные токены - hex-строки, в подписанном токене есть ':'
+        return ':' in value
+
+    @classmethod
+    def issue(cls, session_token, role_ids, lifetime=None):
+        lifetime = lifetime or settings.ACCESS_TOKEN_LIFETIME
+        now = time.time()
+        claims = {
+            'uid': session_token.user_id,
+            'su': session_token.user.is_superuser,
+            'roles': sorted(role_ids),
+            'sid': session_token.pk,
+            'iat': now,
+            'exp': now + lifetime,
+        }
+        return signing.dumps(claims, salt=ACCESS_TOKEN_SALT, compress=True), cls(claims)
+
+    @classmethod
+    def _load(cls, value):
+        try:
+            claims = signing.loads(value, salt=ACCESS_TOKEN_SALT)
+        except signing.BadSignature:
+            raise AccessTokenError('Invalid token')
+
+        token = cls(claims)
+        if token.expires_at <= time.time():
+            raise AccessTokenError('Token expired')
+        return token
+
+    @classmethod
+    def verify(cls, value):
+        token = cls._load(value)
+        if is_revoked(token):
+            raise AccessTokenError('Token revoked')
+        return token
+
+    @classmethod
+    async def averify(cls, value):
+        token = cls._load(value)
+        if await ais_revoked(token):
+            raise AccessTokenError('Token revoked')
+        return token
+
+    def get_user(self):
+        # Пользователь собирается из claims; остальные поля догружаются
+        # из БД только если view к ним обратится
+        return User.from_db(None, ['id', 'is_active', 'is_superuser'], [self.user_id, True, self.is_superuser])
+
+
+def _revocation_cache():
+    # Denylist живет в том же общем кеше, что и кеш токенов
+    options = getattr(settings, 'TOKEN_CACHE', {}).get('OPTIONS', {})
+    return caches[options.get('CACHE_ALIAS', 'default')]
+
+
+def revoke_session(session_id):
+    # Access-токены сессии перестают приниматься до истечения их срока
+    _revocation_cache().set(REVOKED_SESSION_KEY.format(session_id), True, settings.ACCESS_TOKEN_LIFETIME)
+
+
+def revoke_user(user_id):
+    # Отзываются все access-токены пользователя, выпущенные до этого момента
+    _revocation_cache().set(REVOKED_USER_KEY.format(user_id), time.time(), settings.ACCESS_TOKEN_LIFETIME)
+
+
+def _revocation_keys(token):
+    return REVOKED_SESSION_KEY.format(token.session_id), REVOKED_USER_KEY.format(token.user_id)
+
+
+def _check_revoked(token, revoked):
+    session_key, user_key = _revocation_keys(token)
+    if revoked.get(session_key):
+        return True
+    revoked_at = revoked.get(user_key)
+    return revoked_at is not None and token.claims['iat'] <= revoked_at
+
+
+def is_revoked(token):
+    return _check_revoked(token, _revocation_cache().get_many(_revocation_keys(token)))
+
+
+async def ais_revoked(token):
+    return _check_revoked(token, await _revocation_cache().aget_many(_revocation_keys(token)))
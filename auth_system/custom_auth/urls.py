@@ -3,10 +3,12 @@ from rest_framework.routers import DefaultRouter
 from . import views
 
 router = DefaultRouter()
+router.register(r'auth/sessions', views.SessionViewSet, basename='session')
 router.register(r'auth', views.AuthViewSet, basename='auth')
 router.register(r'admin/roles', views.RoleViewSet, basename='role')
 router.register(r'admin/resources', views.ResourceViewSet, basename='resource')
 router.register(r'admin/permissions', views.PermissionViewSet, basename='permission')
+router.register(r'admin/users', views.UserImportViewSet, basename='user-import')
 router.register(r'projects', views.ProjectViewSet, basename='project')
 router.register(r'tasks', views.TaskViewSet, basename='task')
 
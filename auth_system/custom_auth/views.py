@@ -1,15 +1,59 @@
 from rest_framework import status, viewsets
 from rest_framework.decorators import action
 from rest_framework.response import Response
-from rest_framework.views import APIView
-from django.utils import timezone
-from .models import User, SessionToken, Role, Resource, Permission, UserRole
+from rest_framework import exceptions
+import codecs
+import io
+import json
+import logging
+
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from .models import User, SessionToken, Role, Resource, Permission, UserEffectivePermission
 from .serializers import (
     UserRegistrationSerializer, UserProfileSerializer, 
-    UserLoginSerializer, RoleSerializer, ResourceSerializer, PermissionSerializer
+    UserLoginSerializer, RoleSerializer, ResourceSerializer, PermissionSerializer,
+    TokenRefreshSerializer, BulkItemsSerializer, PermissionGrantSerializer,
+    UserRoleAssignmentSerializer, SessionSerializer, AuthorizeBatchSerializer
 )
+from .audit import login_buffer
 from .authentication import SessionTokenAuthentication
+from .bulk import bulk_assign_roles, bulk_grant_permissions
+from .cache import permission_cache
+from .effective import check_permissions
+from .hashing import hashing_pool
+from .imports import import_users, read_rows
+from .pagination import KeysetPagination, NDJSONExportMixin
 from .permissions import CustomPermission
+from .resources import resource_index
+from .routers import replica_reads
+from .sessions import active_sessions, end_all_sessions, end_sessions, start_session
+from .throttling import LoginThrottle
+from .tokens import AccessToken, revoke_session
+
+logger = logging.getLogger('custom_auth.views')
+
+
+def issue_access_token(session_token):
+    access_token, _ = AccessToken.issue(session_token, permission_cache.get_user_roles(session_token.user_id))
+    return {
+        "access_token": access_token,
+        "expires_in": settings.ACCESS_TOKEN_LIFETIME,
+    }
+
+
+def load_full_user(request):
+    # Пользователь из access-токена содержит только поля из claims
+    user = request.user
+    if isinstance(request.auth, AccessToken):
+        user.refresh_from_db(fields=user.get_deferred_fields())
+    return user
+
+def current_session_id(request):
+    # Сессию определяем по токену, которым прошла аутентификация
+    if isinstance(request.auth, AccessToken):
+        return request.auth.session_id
+    return request.auth.pk
 
 class AuthViewSet(viewsets.ViewSet):
     
@@ -23,129 +67,322 @@ class AuthViewSet(viewsets.ViewSet):
             }, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
     
-    @action(detail=False, methods=['post'], authentication_classes=[], permission_classes=[])
+    @action(detail=False, methods=['post'], authentication_classes=[], permission_classes=[],
+            throttle_classes=[LoginThrottle])
     def login(self, request):
         serializer = UserLoginSerializer(data=request.data)
         if serializer.is_valid():
-            email = serializer.validated_data['email']
-            password = serializer.validated_data['password']
+            # Сериализатор уже загрузил пользователя и проверил пароль,
+            # повторный запрос и повторное хэширование не нужны
+            user = serializer.validated_data['user']
             
+            # Создаем токен сессии; самые старые сверх MAX_SESSIONS_PER_USER вытесняются
+            token = start_session(user)
+            # last_login и журнал входов пишутся отложенно, пачкой
+            user.last_login = login_buffer.record(request, user).created_at
+            
+            return Response({
+                "message": "Login successful",
+                "token": token.key,
+                **issue_access_token(token),
+                "user": UserProfileSerializer(user).data
+            })
+        
+        email = request.data.get('email') if hasattr(request.data, 'get') else None
+        login_buffer.record(
+            request, getattr(serializer, 'user', None), success=False,
+            email=email if isinstance(email, str) else ''
+        )
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    
+    @action(detail=False, methods=['post'], authentication_classes=[], permission_classes=[])
+    def refresh(self, request):
+        # Сессионный токен выступает refresh-токеном для короткого access-токена
+        serializer = TokenRefreshSerializer(data=request.data)
+        if serializer.is_valid():
             try:
-                user = User.objects.get(email=email, is_active=True)
-            except User.DoesNotExist:
-                return Response({"error": "Invalid credentials"}, status=status.HTTP_401_UNAUTHORIZED)
+                user, token = SessionTokenAuthentication().authenticate_credentials(
+                    serializer.validated_data['refresh_token']
+                )
+            except exceptions.AuthenticationFailed as e:
+                return Response({"error": e.detail}, status=status.HTTP_401_UNAUTHORIZED)
             
-            if user.check_password(password):
-                # Создаем токен сессии
-                token = SessionToken.generate_token(user)
-                user.last_login = timezone.now()
-                user.save()
-                
-                return Response({
-                    "message": "Login successful",
-                    "token": token.token,
-                    "user": UserProfileSerializer(user).data
-                })
-            else:
-                return Response({"error": "Invalid credentials"}, status=status.HTTP_401_UNAUTHORIZED)
+            return Response(issue_access_token(token))
         
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
     
     @action(detail=False, methods=['post'])
     def logout(self, request):
-        # Получаем токен из заголовка
-        auth_header = request.META.get('HTTP_AUTHORIZATION', '')
-        if auth_header.startswith('Bearer '):
-            token_key = auth_header[7:]
-            try:
-                token = SessionToken.objects.get(token=token_key, user=request.user)
-                token.is_active = False
-                token.save()
-            except SessionToken.DoesNotExist:
-                pass
+        session_id = current_session_id(request)
+        
+        try:
+            token = SessionToken.objects.get(pk=session_id, user_id=request.user.pk)
+            token.is_active = False
+            token.save()
+        except SessionToken.DoesNotExist:
+            pass
+        
+        # Уже выданные access-токены этой сессии попадают в denylist
+        revoke_session(session_id)
         
         return Response({"message": "Logout successful"})
     
     @action(detail=False, methods=['get', 'put'])
     def profile(self, request):
         if request.method == 'GET':
-            serializer = UserProfileSerializer(request.user)
+            serializer = UserProfileSerializer(load_full_user(request))
             return Response(serializer.data)
         
         elif request.method == 'PUT':
-            serializer = UserProfileSerializer(request.user, data=request.data, partial=True)
+            # Пользователь из кеша токенов может отставать от БД на TTL кеша,
+            # для записи он перечитывается
+            user = User.objects.get(pk=request.user.pk)
+            serializer = UserProfileSerializer(user, data=request.data, partial=True)
             if serializer.is_valid():
                 serializer.save()
                 return Response(serializer.data)
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
     
+    @action(detail=False, methods=['get'])
+    def permissions(self, request):
+        # Эффективные права пользователя одним запросом к
+        # UserEffectivePermission; суперпользователю доступно все
+        rows = UserEffectivePermission.objects.filter(user_id=request.user.pk).order_by(
+            'resource__name', 'resource__method'
+        ).values_list('resource__name', 'resource__method', 'can_access')
+        
+        return Response({
+            "is_superuser": request.user.is_superuser,
+            "permissions": [
+                {"resource": name, "method": method, "allowed": allowed}
+                for name, method, allowed in rows
+            ]
+        })
+    
+    @action(detail=False, methods=['post'], url_path='authorize/batch')
+    def authorize_batch(self, request):
+        # Решения по пакету пар (resource, method) за постоянное число
+        # запросов: {"checks": [{"resource": "project_list", "method": "GET"}, ...]}.
+        # С "users": [1, 2] - права этих пользователей (для сервисных клиентов)
+        serializer = AuthorizeBatchSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        
+        checks = [(check['resource'], check['method']) for check in serializer.validated_data['checks']]
+        user_ids = list(dict.fromkeys(serializer.validated_data.get('users', [request.user.pk])))
+        if user_ids != [request.user.pk] and not self._can_check_users(request):
+            return Response({"error": "Not allowed to check other users"}, status=status.HTTP_403_FORBIDDEN)
+        
+        with replica_reads():
+            if user_ids == [request.user.pk]:
+                users = {request.user.pk: request.user.is_superuser}
+            else:
+                # Неактивные и несуществующие пользователи получают отказ
+                users = dict(User.objects.filter(pk__in=user_ids, is_active=True).values_list('pk', 'is_superuser'))
+            decisions = check_permissions(users, checks)
+        
+        denied = [False] * len(checks)
+        return Response({
+            "results": [
+                {"user": user_id, "resource": name, "method": method, "allowed": allowed}
+                for user_id in user_ids
+                for (name, method), allowed in zip(checks, decisions.get(user_id, denied))
+            ]
+        })
+    
+    def _can_check_users(self, request):
+        # Чужие права проверяет суперпользователь или роль с доступом к
+        # ресурсу authorization_check
+        if request.user.is_superuser:
+            return True
+        resource_ids = resource_index.get_resource_ids(
+            self.__class__, self.action, request.method, 'authorization_check'
+        )
+        return permission_cache.is_allowed(request.user, resource_ids, getattr(request.auth, 'role_ids', None))
+    
     @action(detail=False, methods=['delete'])
     def delete_account(self, request):
         user = request.user
         user.is_active = False
-        user.save()
+        user.save(update_fields=['is_active', 'updated_at'])
         
         # Деактивируем все токены пользователя
-        SessionToken.objects.filter(user=user).update(is_active=False)
+        end_all_sessions(user.pk)
         
         return Response({"message": "Account deleted successfully"})
 
+class SessionViewSet(viewsets.ViewSet):
+    # Сессии текущего пользователя: список, завершение одной и выход везде
+    
+    def list(self, request):
+        serializer = SessionSerializer(
+            active_sessions(request.user.pk), many=True,
+            context={'session_id': current_session_id(request)}
+        )
+        return Response({"sessions": serializer.data})
+    
+    def destroy(self, request, pk=None):
+        try:
+            session_id = int(pk)
+        except ValueError:
+            return Response({"error": "Session not found"}, status=status.HTTP_404_NOT_FOUND)
+        if not end_sessions(request.user.pk, [session_id]):
+            return Response({"error": "Session not found"}, status=status.HTTP_404_NOT_FOUND)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+    
+    @action(detail=False, methods=['post'])
+    def logout_all(self, request):
+        count = end_all_sessions(request.user.pk)
+        return Response({"message": "Logged out everywhere", "sessions": count})
+
 # Административные view для управления правами доступа
-class RoleViewSet(viewsets.ModelViewSet):
+class RoleViewSet(NDJSONExportMixin, viewsets.ModelViewSet):
     queryset = Role.objects.all()
     serializer_class = RoleSerializer
     permission_classes = [CustomPermission]
+    pagination_class = KeysetPagination
+    resource_name = 'role_management'
+    # Назначение ролей - отдельное право, а не любое изменение ролей
+    resource_names = {'assign': 'role_assignment'}
+    export_fields = {'id': 'id', 'name': 'name', 'description': 'description'}
     
-    def get_resource_name(self, request):
-        method = request.method
-        if method == 'GET':
-            return 'role_management'
-        elif method == 'POST':
-            return 'role_management'
-        return 'role_management'
+    @action(detail=False, methods=['post'])
+    def assign(self, request):
+        # Массовое назначение ролей пользователям: {"items": [{"user": 1, "role": 2}, ...]}.
+        # Не суперпользователь назначает только роли, которые есть у него
+        # самого (с унаследованными), иначе мог бы выдать себе admin
+        serializer = BulkItemsSerializer(data=request.data)
+        if serializer.is_valid():
+            allowed_roles = None if request.user.is_superuser else permission_cache.get_user_roles(request.user.pk)
+            results = bulk_assign_roles(
+                serializer.validated_data['items'], UserRoleAssignmentSerializer, allowed_roles
+            )
+            return Response({"results": results})
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-class ResourceViewSet(viewsets.ModelViewSet):
+class ResourceViewSet(NDJSONExportMixin, viewsets.ModelViewSet):
     queryset = Resource.objects.all()
     serializer_class = ResourceSerializer
     permission_classes = [CustomPermission]
-    resource_name = 'ResourceManagement'
+    pagination_class = KeysetPagination
+    resource_name = 'resource_management'
+    export_fields = {'id': 'id', 'name': 'name', 'description': 'description', 'method': 'method'}
     
     def get_queryset(self):
         if not hasattr(self.request.user, 'is_superuser') or not self.request.user.is_superuser:
             return Resource.objects.none()
         return Resource.objects.all()
 
-class PermissionViewSet(viewsets.ModelViewSet):
+class PermissionViewSet(NDJSONExportMixin, viewsets.ModelViewSet):
     queryset = Permission.objects.all()
     serializer_class = PermissionSerializer
     permission_classes = [CustomPermission]
-    resource_name = 'PermissionManagement'
+    pagination_class = KeysetPagination
+    resource_name = 'permission_management'
+    # Те же ключи, что и у PermissionSerializer
+    export_fields = {
+        'id': 'id',
+        'role': 'role_id',
+        'role_name': 'role__name',
+        'resource': 'resource_id',
+        'resource_name': 'resource__name',
+        'can_access': 'can_access',
+        'created_at': 'created_at',
+    }
     
     def get_queryset(self):
         if not hasattr(self.request.user, 'is_superuser') or not self.request.user.is_superuser:
             return Permission.objects.none()
         return Permission.objects.select_related('role', 'resource')
+    
+    @action(detail=False, methods=['post'])
+    def bulk(self, request):
+        # Массовая выдача прав: {"items": [{"role": 1, "resource": 2, "can_access": true}, ...]}
+        serializer = BulkItemsSerializer(data=request.data)
+        if serializer.is_valid():
+            results = bulk_grant_permissions(serializer.validated_data['items'], PermissionGrantSerializer)
+            return Response({"results": results})
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+class UserImportViewSet(viewsets.ViewSet):
+    permission_classes = [CustomPermission]
+    resource_name = 'user_management'
+    
+    @action(detail=False, methods=['post'], url_path='import')
+    def import_users(self, request):
+        # Тело - CSV (text/csv) или NDJSON (application/x-ndjson), читается потоком.
+        # Ответ - NDJSON с отчетом по каждой пачке; оборванный импорт
+        # продолжается тем же файлом с ?offset=<offset последнего отчета>
+        format = 'ndjson' if 'ndjson' in request.content_type else 'csv'
+        stream = self.get_stream(request)
+        if stream is None:
+            return Response({"error": "Request body is empty"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            offset = int(request.query_params.get('offset', 0))
+            batch_size = int(request.query_params.get('batch_size', 1000))
+        except ValueError:
+            return Response({"error": "offset and batch_size must be integers"}, status=status.HTTP_400_BAD_REQUEST)
+        
+        roles = request.query_params.getlist('role')
+        missing = set(roles) - set(Role.objects.filter(name__in=roles).values_list('name', flat=True))
+        if missing:
+            return Response({"role": [f'Unknown role "{name}".' for name in sorted(missing)]},
+                            status=status.HTTP_400_BAD_REQUEST)
+        
+        # Открытые пароли хэшируются в общем пуле: его очередь ограничена,
+        # и при перегрузке импорт, как и вход, получает 429
+        offset = max(offset, 0)
+        reports = import_users(
+            read_rows(codecs.getreader('utf-8')(stream), format),
+            batch_size=max(1, min(batch_size, 5000)),
+            offset=offset,
+            default_roles=roles,
+            hash_passwords=hashing_pool.make_passwords,
+        )
+        # Первая пачка обрабатывается до ответа: ее ошибки (в том числе 429)
+        # возвращаются обычным ответом DRF
+        first = next(reports, None)
+        return StreamingHttpResponse(self.stream_reports(first, reports, offset), content_type='application/x-ndjson')
+    
+    def get_stream(self, request):
+        # DRF не отдает тело без Content-Length (chunked): тогда оно читается
+        # из wsgi.input, а под ASGI - из уже принятого request.body
+        if request.stream is not None:
+            return request.stream
+        if request.META.get('CONTENT_LENGTH'):
+            return None
+        if 'wsgi.input' in request.META:
+            return request.META['wsgi.input']
+        return io.BytesIO(request.body) if request.body else None
+    
+    def stream_reports(self, first, reports, offset):
+        # Пачки до сбоя уже закоммичены; сбой пачки (откатывается целиком)
+        # завершает ответ записью {"error": ...} с offset для продолжения
+        report = first
+        try:
+            while report is not None:
+                offset = report['offset']
+                yield json.dumps(report) + '\n'
+                report = next(reports, None)
+        except Exception as e:
+            logger.exception('User import failed after row %s', offset)
+            error = e.detail if isinstance(e, exceptions.APIException) else 'Import failed'
+            yield json.dumps({"error": str(error), "offset": offset}) + '\n'
 
 # Mock views для бизнес-логики
 class ProjectViewSet(viewsets.ViewSet):
     permission_classes = [CustomPermission]
-    
-    def get_resource_name(self, request):
-        # Динамически определяем имя ресурса в зависимости от метода
-        method = request.method
-        if method == 'GET' and not request.parser_context.get('kwargs'):
-            return 'project_list'
-        elif method == 'POST':
-            return 'project_create'
-        elif method == 'PUT':
-            return 'project_update'
-        elif method == 'DELETE':
-            return 'project_delete'
-        return 'project_list'
+    # Имена ресурсов по действиям; CustomPermission берет их из индекса маршрутов
+    resource_names = {
+        'list': 'project_list',
+        'retrieve': 'project_list',
+        'create': 'project_create',
+        'update': 'project_update',
+        'partial_update': 'project_update',
+        'destroy': 'project_delete',
+    }
     
     def list(self, request):
-        # Устанавливаем resource_name для проверки прав
-        request.resource_name = 'project_list'
         return Response({
             "projects": [
                 {"id": 1, "name": "Project Alpha", "status": "active"},
@@ -154,35 +391,28 @@ class ProjectViewSet(viewsets.ViewSet):
         })
     
     def create(self, request):
-        request.resource_name = 'project_create'
         return Response({
             "message": "Project created successfully",
             "project_id": 3
         }, status=status.HTTP_201_CREATED)
     
     def destroy(self, request, pk=None):
-        request.resource_name = 'project_delete'
         # Здесь должна быть логика удаления проекта
         # Но сначала проверяются права через CustomPermission
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 class TaskViewSet(viewsets.ViewSet):
     permission_classes = [CustomPermission]
-    
-    def get_resource_name(self, request):
-        method = request.method
-        if method == 'GET' and not request.parser_context.get('kwargs'):
-            return 'task_list'
-        elif method == 'POST':
-            return 'task_create'
-        elif method == 'PUT':
-            return 'task_update'
-        elif method == 'DELETE':
-            return 'task_delete'
-        return 'task_list'
+    resource_names = {
+        'list': 'task_list',
+        'retrieve': 'task_list',
+        'create': 'task_create',
+        'update': 'task_update',
+        'partial_update': 'task_update',
+        'destroy': 'task_delete',
+    }
     
     def list(self, request):
-        request.resource_name = 'task_list'
         return Response({
             "tasks": [
                 {"id": 1, "title": "Design database", "status": "done"},
@@ -191,7 +421,6 @@ class TaskViewSet(viewsets.ViewSet):
         })
     
     def create(self, request):
-        request.resource_name = 'task_create'
         return Response({
             "message": "Task created successfully",
             "task_id": 3